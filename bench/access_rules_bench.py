@@ -0,0 +1,102 @@
+"""
+Import a large IP list as a document through the dispatcher against the stub APIs:
+a fresh import, a re-import of the same list (nothing to change) and an unblock.
+Usage: python bench/access_rules_bench.py --entries 10000 --existing 2000 --latency 0.05
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import common
+from mock_telegram import BENCH_ADMIN_ID, create_app as create_telegram_app, document_update
+
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import main
+from mock_cloudflare import create_app as create_cloudflare_app, start_server
+
+
+def generate_list(count, seed):
+    """Messy operator list: duplicate IPs, overlapping CIDRs, IPv6, ASNs, countries, comments and junk."""
+    rng = random.Random(seed)
+    prefixes = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}" for _ in range(400)]
+    lines = ["# exported from the WAF log"]
+    for index in range(count):
+        roll = rng.random()
+        if roll < 0.85:
+            line = f"{rng.choice(prefixes)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        elif roll < 0.88:
+            line = f"{rng.choice(prefixes)}.{rng.randint(0, 255)}.0/{rng.choice((22, 24, 28))}"
+        elif roll < 0.95:
+            line = f"2001:db8:{rng.randint(0, 0xffff):x}::{rng.randint(1, 0xffff):x}"
+        elif roll < 0.97:
+            line = f"AS{rng.randint(1000, 65000)}"
+        elif roll < 0.99:
+            line = rng.choice(("CN", "RU", "BR", "IN", "T1"))
+        else:
+            line = f"not-an-ip-{index}"
+        lines.append(line + (" # seen twice" if index % 7 == 0 else ""))
+    return "\n".join(lines).encode()
+
+
+async def run(name, telegram, cloudflare, update_id, caption):
+    cloudflare["endpoints"].clear()
+    telegram["calls"].clear()
+    update = Update(**document_update(update_id, BENCH_ADMIN_ID, "list", caption))
+    start = time.perf_counter()
+    await main.dp.feed_update(main.bot, update)
+    elapsed = time.perf_counter() - start
+    rules = sum(len(rules) for rules in cloudflare["access_rules"].values())
+    print(f"{name:<28} elapsed={elapsed:6.2f}s rules in zone={rules}")
+    common.report_calls("cloudflare", cloudflare["endpoints"])
+
+
+async def bench(args):
+    logging.disable(logging.CRITICAL)
+    body = generate_list(args.entries, args.seed)
+    start = time.perf_counter()
+    entries = main.AccessList()
+    for line in body.decode().splitlines():
+        entries.add_line(line)
+    targets = list(entries.targets())
+    print(f"{'parse + collapse':<28} elapsed={time.perf_counter() - start:6.2f}s entries={entries.entries} rules={len(targets)} invalid={entries.invalid}")
+
+    cloudflare = create_cloudflare_app(args.latency)
+    telegram = create_telegram_app()
+    telegram["files"]["list"] = body
+    cloudflare_runner, cloudflare_url = await start_server(cloudflare)
+    telegram_runner, telegram_url = await start_server(telegram)
+    main.cf.base_url = cloudflare_url
+    main.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+    main.ALLOWED_USERS.add(BENCH_ADMIN_ID)
+    await main.cf.start()
+    try:
+        # Rules that already exist: some match the list, some need a different mode
+        rules = cloudflare["access_rules"].setdefault(main.DEFAULT_ZONE_ID, {})
+        for index, (target, value) in enumerate(targets[:args.existing]):
+            rule_id = f"seed{index}"
+            mode = "block" if index % 2 else "managed_challenge"
+            rules[rule_id] = {"id": rule_id, "mode": mode, "configuration": {"target": target, "value": value}}
+            cloudflare["access_rule_ids"][(main.DEFAULT_ZONE_ID, target, value)] = rule_id
+        await run("import (fresh)", telegram, cloudflare, 1, "/block")
+        main.access_rule_indexes.clear()
+        await run("re-import (cold index)", telegram, cloudflare, 2, "/block")
+        await run("re-import (warm index)", telegram, cloudflare, 3, "/block")
+        await run("unblock", telegram, cloudflare, 4, "/unblock")
+    finally:
+        await main.cf.close()
+        await main.bot.session.close()
+        await cloudflare_runner.cleanup()
+        await telegram_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--existing", type=int, default=2000, help="rules created before the import")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub Cloudflare latency in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(bench(parser.parse_args()))
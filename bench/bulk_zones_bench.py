@@ -0,0 +1,48 @@
+"""
+Apply a security level to many zones through set_security_level_bulk against the stub API.
+Usage: python bench/bulk_zones_bench.py --zones 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import time
+
+import common  # noqa: F401  (sets up env and sys.path)
+
+import main
+from mock_cloudflare import create_app, start_server
+
+
+async def bench(args):
+    app = create_app(args.latency)
+    runner, base_url = await start_server(app)
+    main.cf.base_url = base_url
+    zones = {f"zone{i}": f"bench-zone-{i}" for i in range(args.zones)}
+    main.CLOUDFLARE_ZONES.clear()
+    main.CLOUDFLARE_ZONES.update(zones)
+    main.ZONE_NAMES.update({zone_id: name for name, zone_id in zones.items()})
+    try:
+        for concurrency in (1, args.concurrency):
+            main.cf.rate_limiter = main.RateLimiter(args.rate_limit, args.rate_burst)
+            start = time.perf_counter()
+            results = await main.set_security_level_bulk(args.level, concurrency=concurrency)
+            elapsed = time.perf_counter() - start
+            applied = sum(app["settings"].get((zone_id, "security_level")) == args.level for zone_id in zones.values())
+            failed = sum(main.is_error_status(result) for result, _ in results.values())
+            print(f"concurrency={concurrency:<3} zones={len(results)} applied={applied} failed={failed} elapsed={elapsed:.2f}s")
+            app["settings"].clear()
+        message, _ = await main.apply_security_level_to_all_zones(args.level)
+        print(message)
+    finally:
+        await main.cf.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zones", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=main.BULK_CONCURRENCY)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub server latency in seconds")
+    parser.add_argument("--level", default="under_attack")
+    parser.add_argument("--rate-limit", type=float, default=3.8, help="token bucket rate, requests per second")
+    parser.add_argument("--rate-burst", type=int, default=60)
+    asyncio.run(bench(parser.parse_args()))
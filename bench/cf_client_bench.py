@@ -0,0 +1,54 @@
+"""
+Compare the shared CloudflareClient against the old per-call ClientSession.
+Usage: python bench/cf_client_bench.py --requests 2000 --concurrency 20
+"""
+import argparse
+import asyncio
+import time
+
+import common  # noqa: F401  (sets up env and sys.path)
+import aiohttp
+
+import main
+from mock_cloudflare import create_app, start_server
+
+
+async def per_call_session(base_url):
+    # Mirrors the original code path: a fresh session (and connection) per call.
+    url = f"{base_url}/zones/{main.CLOUDFLARE_ZONE_ID}/settings/security_level"
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, headers=main.cf.headers) as resp:
+            await resp.json()
+
+
+async def run(name, call, total, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await common.timed(call, latencies)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    common.report(name, latencies, time.perf_counter() - start)
+
+
+async def bench(args):
+    runner, base_url = await start_server(create_app(args.latency))
+    main.cf.base_url = base_url
+    try:
+        await run("per-call ClientSession", lambda: per_call_session(base_url), args.requests, args.concurrency)
+        # fetch_* bypasses the settings cache so every call reaches the stub server
+        await run("shared CloudflareClient", main.fetch_security_level_status, args.requests, args.concurrency)
+    finally:
+        await main.cf.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub server latency in seconds")
+    asyncio.run(bench(parser.parse_args()))
@@ -0,0 +1,53 @@
+"""Shared helpers for the benchmark scripts."""
+import os
+import statistics
+import sys
+import time
+import warnings
+
+# The scripts tweak stub servers (latency, error rate) while they are running.
+warnings.filterwarnings("ignore", message="Changing state of started or joined application")
+
+# main.py validates the token at import time, so give it a well-formed fake one.
+os.environ.setdefault("BOT_TOKEN", "123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+os.environ.setdefault("CLOUDFLARE_ZONE_ID", "bench-zone")
+os.environ.setdefault("METRICS_PORT", "0")
+# Keep bench runs from touching the bot's state database.
+os.environ.setdefault("STATE_DB_PATH", "")
+# The stub API has no rate limit; scripts that exercise the limiter set their own.
+os.environ.setdefault("CLOUDFLARE_RATE_LIMIT", "1000000")
+os.environ.setdefault("CLOUDFLARE_RATE_BURST", "1000000")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name, latencies, elapsed, extra=""):
+    rps = len(latencies) / elapsed if elapsed else 0.0
+    print(
+        f"{name:<28} n={len(latencies):<6} "
+        f"p50={percentile(latencies, 50) * 1000:7.2f}ms "
+        f"p95={percentile(latencies, 95) * 1000:7.2f}ms "
+        f"p99={percentile(latencies, 99) * 1000:7.2f}ms "
+        f"mean={statistics.fmean(latencies) * 1000 if latencies else 0:7.2f}ms "
+        f"rps={rps:9.1f} {extra}"
+    )
+
+
+def report_calls(label, counts):
+    """Print call counts (e.g. upstream endpoints or Bot API methods), busiest first."""
+    total = sum(counts.values())
+    details = ", ".join(f"{key}={count}" for key, count in sorted(counts.items(), key=lambda item: -item[1]))
+    print(f"  {label:<12} total={total:<6} {details}")
+
+
+async def timed(coro_factory, latencies):
+    start = time.perf_counter()
+    await coro_factory()
+    latencies.append(time.perf_counter() - start)
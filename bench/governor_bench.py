@@ -0,0 +1,71 @@
+"""
+Exercise the Cloudflare request governor against a stub API that injects 429/503 responses.
+Usage: python bench/governor_bench.py --requests 200 --error-rate 0.3
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+import common  # noqa: F401  (sets up env and sys.path)
+
+import main
+from mock_cloudflare import create_app, start_server
+
+
+async def run(name, app, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    app["injected"].clear()
+    app["calls"] = 0
+
+    async def one(index):
+        async with semaphore:
+            level = "under_attack" if index % 2 else "high"
+            start = time.perf_counter()
+            result, _ = await main.set_security_level(level)
+            latencies.append(time.perf_counter() - start)
+            return not main.is_error_status(result)
+
+    start = time.perf_counter()
+    succeeded = sum(await asyncio.gather(*(one(index) for index in range(total))))
+    upstream = app["calls"] + sum(app["injected"].values())
+    common.report(name, latencies, time.perf_counter() - start, f"ok={succeeded}/{total} upstream={upstream} injected={app['injected']}")
+
+
+async def bench(args):
+    logging.disable(logging.CRITICAL)
+    app = create_app(args.latency, args.error_rate, retry_after=args.retry_after)
+    runner, base_url = await start_server(app)
+    main.cf.base_url = base_url
+    main.cf.backoff_base = args.backoff_base
+    try:
+        retries = main.cf.write_retries
+        main.cf.write_retries = 0
+        await run("no retries", app, args.requests, args.concurrency)
+        main.cf.write_retries = retries
+        main.cf.breaker = main.CircuitBreaker(main.CLOUDFLARE_BREAKER_THRESHOLD, main.CLOUDFLARE_BREAKER_RESET)
+        await run("governor", app, args.requests, args.concurrency)
+
+        # A hard outage trips the breaker; reads then fail fast instead of piling up retries.
+        app["error_rate"], app["error_statuses"] = 1.0, (503,)
+        app["injected"].clear()
+        main.cf.breaker = main.CircuitBreaker(main.CLOUDFLARE_BREAKER_THRESHOLD, main.CLOUDFLARE_BREAKER_RESET)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(main.fetch_security_level_status() for _ in range(20)))
+        print(f"outage: breaker open={main.cf.breaker.opened_at is not None} "
+              f"upstream={sum(app['injected'].values())} elapsed={time.perf_counter() - start:.2f}s sample={results[-1]!r}")
+    finally:
+        await main.cf.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.3)
+    parser.add_argument("--retry-after", type=float, default=0.05)
+    parser.add_argument("--backoff-base", type=float, default=0.02, help="shortened so the run finishes quickly")
+    asyncio.run(bench(parser.parse_args()))
@@ -0,0 +1,225 @@
+"""
+Local stub of the Cloudflare API used by the benchmarks.
+Run standalone with: python bench/mock_cloudflare.py --port 8787 --latency 0.02 --error-rate 0.3
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import random
+import re
+import zlib
+
+from aiohttp import web
+
+
+def hourly_groups(zone_id, limit, now=None):
+    """Deterministic synthetic httpRequests1hGroups for a zone, newest first."""
+    now = (now or datetime.datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+    groups = []
+    for offset in range(limit):
+        started = now - datetime.timedelta(hours=offset)
+        seed = zlib.crc32(f"{zone_id}{started.isoformat()}".encode())
+        requests = 1000 + seed % 9000
+        ok = requests * 9 // 10
+        groups.append({
+            "sum": {
+                "requests": requests,
+                "threats": seed % 97,
+                "cachedRequests": requests * (seed % 80) // 100,
+                "countryMap": [
+                    {"clientCountryName": country, "requests": requests * share // 100}
+                    for country, share in (("RU", 50), ("US", 20), ("DE", 15), ("NL", 10), ("CN", 5))
+                ],
+                "responseStatusMap": [
+                    {"edgeResponseStatus": 200, "requests": ok},
+                    {"edgeResponseStatus": 403, "requests": requests - ok - seed % 10},
+                    {"edgeResponseStatus": 502, "requests": seed % 10},
+                ],
+            },
+            "dimensions": {"datetime": started.isoformat() + "Z"},
+        })
+    return groups
+
+
+def minute_groups(zone_id, limit, attack=False, now=None):
+    """Synthetic httpRequests1mGroups for the minutes before `now`, oldest first."""
+    now = (now or datetime.datetime.utcnow()).replace(second=0, microsecond=0)
+    groups = []
+    for offset in range(limit, 0, -1):
+        started = now - datetime.timedelta(minutes=offset)
+        seed = zlib.crc32(f"{zone_id}{started.isoformat()}".encode())
+        requests = (20000 if attack else 1000) + seed % 500
+        groups.append({
+            "sum": {
+                "requests": requests,
+                "threats": requests // 4 if attack else seed % 20,
+                "cachedRequests": requests // 50 if attack else requests * 7 // 10,
+            },
+            "dimensions": {"datetime": started.isoformat() + "Z"},
+        })
+    return groups
+
+
+def top_paths(zone_id, limit):
+    paths = ["/", "/login", "/api/search", "/wp-login.php", "/static/app.js", "/xmlrpc.php"][:limit]
+    return [{"count": 5000 // (rank + 1), "dimensions": {"clientRequestPath": path}} for rank, path in enumerate(paths)]
+
+
+@web.middleware
+async def count_calls(request, handler):
+    """Count every request, injected failures included, per "METHOD /route"."""
+    resource = request.match_info.route.resource
+    key = f"{request.method} {resource.canonical if resource is not None else request.path}"
+    request.app["endpoints"][key] = request.app["endpoints"].get(key, 0) + 1
+    return await handler(request)
+
+
+@web.middleware
+async def inject_errors(request, handler):
+    app = request.app
+    if app["error_rate"] and app["random"].random() < app["error_rate"]:
+        status = app["random"].choice(app["error_statuses"])
+        app["injected"][status] = app["injected"].get(status, 0) + 1
+        headers = {"Retry-After": str(app["retry_after"])} if status == 429 and app["retry_after"] is not None else {}
+        body = {"success": False, "errors": [{"code": 10000 + status, "message": "injected failure"}], "result": None}
+        return web.json_response(body, status=status, headers=headers)
+    return await handler(request)
+
+
+def create_app(latency=0.0, error_rate=0.0, error_statuses=(429, 503), retry_after=None, seed=0):
+    """
+    error_rate: share of requests answered with one of error_statuses instead of
+    being served; 429 responses carry Retry-After when retry_after is set.
+    """
+    app = web.Application(middlewares=[count_calls, inject_errors])
+    app["latency"] = latency
+    app["error_rate"] = error_rate
+    app["error_statuses"] = error_statuses
+    app["retry_after"] = retry_after
+    app["random"] = random.Random(seed)
+    app["injected"] = {}
+    app["endpoints"] = {}
+    app["calls"] = 0
+    app["graphql_calls"] = 0
+    app["attack"] = False
+    app["settings"] = {}
+    app["access_rules"] = {}  # zone_id -> {rule id: rule}, in creation order
+    app["access_rule_ids"] = {}  # (zone_id, target, value) -> rule id
+    rule_ids = itertools.count(1)
+
+    async def delay():
+        app["calls"] += 1
+        if app["latency"]:
+            await asyncio.sleep(app["latency"])
+
+    def setting(zone_id, name, default):
+        return app["settings"].setdefault((zone_id, name), default)
+
+    async def security_level(request):
+        await delay()
+        zone_id = request.match_info["zone_id"]
+        if request.method == "PATCH":
+            body = await request.json()
+            app["settings"][(zone_id, "security_level")] = body["value"]
+        value = setting(zone_id, "security_level", "medium")
+        return web.json_response({"success": True, "errors": [], "result": {"id": "security_level", "value": value}})
+
+    async def browser_check(request):
+        await delay()
+        zone_id = request.match_info["zone_id"]
+        if request.method == "PATCH":
+            body = await request.json()
+            app["settings"][(zone_id, "browser_check")] = body["value"]
+        value = setting(zone_id, "browser_check", "on")
+        return web.json_response({"success": True, "errors": [], "result": {"id": "browser_check", "value": value}})
+
+    async def bot_management(request):
+        await delay()
+        zone_id = request.match_info["zone_id"]
+        if request.method == "PUT":
+            body = await request.json()
+            app["settings"][(zone_id, "fight_mode")] = bool(body.get("super_fight_mode", body.get("fight_mode")))
+        value = setting(zone_id, "fight_mode", False)
+        return web.json_response({"success": True, "errors": [], "result": {"fight_mode": value}})
+
+    async def access_rules(request):
+        await delay()
+        zone_id = request.match_info["zone_id"]
+        rules = app["access_rules"].setdefault(zone_id, {})
+        if request.method == "GET":
+            page = int(request.query.get("page", 1))
+            per_page = int(request.query.get("per_page", 20))
+            items = list(rules.values())[(page - 1) * per_page:page * per_page]
+            info = {"page": page, "per_page": per_page, "count": len(items), "total_count": len(rules),
+                    "total_pages": max(1, -(-len(rules) // per_page))}
+            return web.json_response({"success": True, "errors": [], "result": items, "result_info": info})
+        body = await request.json()
+        key = (zone_id, body["configuration"]["target"], body["configuration"]["value"])
+        if key in app["access_rule_ids"]:
+            error = {"code": 10009, "message": "firewallaccessrules.api.duplicate_of_existing"}
+            return web.json_response({"success": False, "errors": [error], "result": None}, status=400)
+        rule = {"id": f"rule{next(rule_ids)}", "mode": body["mode"], "configuration": body["configuration"], "notes": body.get("notes", "")}
+        rules[rule["id"]] = rule
+        app["access_rule_ids"][key] = rule["id"]
+        return web.json_response({"success": True, "errors": [], "result": rule})
+
+    async def access_rule(request):
+        await delay()
+        zone_id = request.match_info["zone_id"]
+        rules = app["access_rules"].setdefault(zone_id, {})
+        rule = rules.get(request.match_info["rule_id"])
+        if rule is None:
+            return web.json_response({"success": False, "errors": [{"code": 10001, "message": "not found"}], "result": None}, status=404)
+        if request.method == "DELETE":
+            del rules[rule["id"]]
+            del app["access_rule_ids"][(zone_id, rule["configuration"]["target"], rule["configuration"]["value"])]
+            return web.json_response({"success": True, "errors": [], "result": {"id": rule["id"]}})
+        rule["mode"] = (await request.json())["mode"]
+        return web.json_response({"success": True, "errors": [], "result": rule})
+
+    async def graphql(request):
+        await delay()
+        app["graphql_calls"] += 1
+        query = (await request.json())["query"]
+        zone_ids = re.findall(r'"([^"]+)"', re.search(r"zoneTag(?:_in)?:\s*\[?([^\]}]*)", query).group(1))
+        limits = [int(limit) for limit in re.findall(r"limit:\s*(\d+)", query)]
+        if "httpRequests1mGroups" in query:
+            zones = [
+                {"zoneTag": zone_id, "httpRequests1mGroups": minute_groups(zone_id, limits[0], app["attack"])}
+                for zone_id in zone_ids
+            ]
+            return web.json_response({"data": {"viewer": {"zones": zones}}, "errors": None})
+        zones = [
+            {"zoneTag": zone_id, "hourly": hourly_groups(zone_id, limits[0]), "topPaths": top_paths(zone_id, limits[-1])}
+            for zone_id in zone_ids
+        ]
+        return web.json_response({"data": {"viewer": {"zones": zones}}, "errors": None})
+
+    app.router.add_route("*", "/zones/{zone_id}/settings/security_level", security_level)
+    app.router.add_route("*", "/zones/{zone_id}/settings/browser_check", browser_check)
+    app.router.add_route("*", "/zones/{zone_id}/bot_management", bot_management)
+    app.router.add_route("*", "/zones/{zone_id}/firewall/access_rules/rules", access_rules)
+    app.router.add_route("*", "/zones/{zone_id}/firewall/access_rules/rules/{rule_id}", access_rule)
+    app.router.add_post("/graphql", graphql)
+    return app
+
+
+async def start_server(app, host="127.0.0.1", port=0):
+    """Start the app in the running loop and return (runner, base_url)."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.error_rate, retry_after=args.retry_after), host="127.0.0.1", port=args.port)
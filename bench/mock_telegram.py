@@ -0,0 +1,142 @@
+"""
+Minimal fake Telegram Bot API: answers the methods the bot uses, serves queued
+updates through getUpdates and records when each outgoing call arrives.
+"""
+import asyncio
+import itertools
+import re
+import time
+
+from aiohttp import web
+
+BENCH_ADMIN_ID = 424242
+
+
+def message_update(update_id, chat_id, text, user_id=BENCH_ADMIN_ID):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    }
+
+
+def parse_html(html_text):
+    """Turn the bot's <b>/<code> markup back into plain text plus entities, the way Telegram stores it."""
+    text, entities = "", []
+    for part in re.split(r"(<b>.*?</b>|<code>.*?</code>)", html_text):
+        match = re.fullmatch(r"<(b|code)>(.*?)</\1>", part)
+        value = match.group(2) if match else part
+        value = value.replace("&lt;", "<").replace("&gt;", ">").replace("&quot;", '"').replace("&amp;", "&")
+        if match:
+            entities.append({
+                "type": "bold" if match.group(1) == "b" else "code",
+                "offset": len(text.encode("utf-16-le")) // 2,
+                "length": len(value.encode("utf-16-le")) // 2,
+            })
+        text += value
+    return text, entities
+
+
+def callback_update(update_id, chat_id, data, message_id=1, text="🔒 Статус Anti-DDoS:", user_id=BENCH_ADMIN_ID, reply_markup=None):
+    """text is the HTML the bot last rendered into the message; reply_markup is an InlineKeyboardMarkup dict."""
+    plain, entities = parse_html(text)
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "text": plain,
+        "entities": entities,
+    }
+    if reply_markup is not None:
+        message["reply_markup"] = reply_markup
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(chat_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "data": data,
+            "message": message,
+        },
+    }
+
+
+def document_update(update_id, chat_id, file_id, caption, user_id=BENCH_ADMIN_ID):
+    """A message carrying an uploaded document; register its bytes in app["files"][file_id]."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "document": {"file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.txt"},
+            "caption": caption,
+        },
+    }
+
+
+def create_app(latency=0.0):
+    app = web.Application()
+    app["latency"] = latency
+    app["updates"] = asyncio.Queue()
+    app["calls"] = {}
+    app["responses"] = []  # (arrival time, method, chat_id)
+    app["files"] = {}  # file_id -> bytes served through getFile and /file/
+    message_ids = itertools.count(1000)
+
+    async def api(request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            payload = dict(await request.post())
+        app["calls"][method] = app["calls"].get(method, 0) + 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await next_updates(payload)})
+        if app["latency"]:
+            await asyncio.sleep(app["latency"])
+        chat_id = payload.get("chat_id")
+        app["responses"].append((time.perf_counter(), method, int(chat_id) if chat_id else None))
+        if method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": int(payload.get("message_id") or next(message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"},
+                "text": payload.get("text", ""),
+            }
+        elif method == "getFile":
+            file_id = payload["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(app["files"][file_id]), "file_path": f"documents/{file_id}"}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def next_updates(payload):
+        queue = app["updates"]
+        timeout = float(payload.get("timeout") or 0)
+        limit = int(payload.get("limit") or 100)
+        try:
+            batch = [await asyncio.wait_for(queue.get(), timeout or 0.01)]
+        except asyncio.TimeoutError:
+            return []
+        while len(batch) < limit and not queue.empty():
+            batch.append(queue.get_nowait())
+        return batch
+
+    async def download(request):
+        body = app["files"].get(request.match_info["path"].rsplit("/", 1)[-1])
+        if body is None:
+            return web.Response(status=404)
+        return web.Response(body=body)
+
+    app.router.add_post("/bot{token}/{method}", api)
+    app.router.add_get("/file/bot{token}/{path:.+}", download)
+    return app
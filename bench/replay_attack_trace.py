@@ -0,0 +1,58 @@
+"""
+Replay a recorded per-minute traffic trace (JSON lines with datetime, requests,
+threats, cachedRequests) through the attack detection rules, without any I/O.
+Known traces are checked against their expected decisions when replayed
+with the stock rules; the script exits non-zero on a mismatch.
+Usage: python bench/replay_attack_trace.py bench/traces/attack_http_flood.jsonl --request-rate 5000
+"""
+import argparse
+import json
+import os
+import sys
+
+import common  # noqa: F401  (sets up env and sys.path)
+
+import main
+
+STOCK_RULES = {"request_rate": 5000, "threat_ratio": 0.2, "origin_ratio": 0.95, "window": 5, "escalate_after": 2, "deescalate_after": 15}
+# trace file -> [(minute, decision)] expected with STOCK_RULES
+EXPECTED = {
+    # Flood in minutes 15-29: escalate on its second hot minute, revert once
+    # the 5-minute window has been calm for 15 minutes (30 + 4 + 14)
+    "attack_http_flood.jsonl": [("2026-10-01T12:16:00Z", "escalate"), ("2026-10-01T12:48:00Z", "deescalate")],
+}
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace")
+    parser.add_argument("--request-rate", type=float, default=main.ATTACK_REQUEST_RATE)
+    parser.add_argument("--threat-ratio", type=float, default=main.ATTACK_THREAT_RATIO)
+    parser.add_argument("--origin-ratio", type=float, default=main.ATTACK_ORIGIN_RATIO)
+    parser.add_argument("--window", type=int, default=main.ATTACK_WINDOW_MINUTES)
+    parser.add_argument("--escalate-after", type=int, default=main.ATTACK_ESCALATE_AFTER)
+    parser.add_argument("--deescalate-after", type=int, default=main.ATTACK_DEESCALATE_AFTER)
+    args = parser.parse_args()
+
+    samples = load_trace(args.trace)
+    rules = {"request_rate": args.request_rate, "threat_ratio": args.threat_ratio, "origin_ratio": args.origin_ratio}
+    options = {"window": args.window, "escalate_after": args.escalate_after, "deescalate_after": args.deescalate_after}
+    decisions = main.replay_trace(samples, rules=rules, **options)
+    print(f"{len(samples)} samples, {len(decisions)} decisions")
+    for moment, decision, reason in decisions:
+        print(f"{moment}  {decision:<10} {reason}")
+
+    expected = EXPECTED.get(os.path.basename(args.trace))
+    if expected is None or {**rules, **options} != STOCK_RULES:
+        print("no expected decisions for this trace and rules, nothing to check")
+        sys.exit(0)
+    actual = [(moment, decision) for moment, decision, _ in decisions]
+    if actual != expected:
+        print(f"FAIL: expected {expected}")
+        sys.exit(1)
+    print("OK: decisions match the expected escalate/deescalate points")
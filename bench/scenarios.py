@@ -0,0 +1,218 @@
+"""
+End-to-end load scenarios: synthetic updates go through the fake Telegram
+getUpdates into the real dispatcher, and every Cloudflare call lands on the
+stub API. Reports update latency (enqueue -> handler done), throughput and
+upstream call counts per scenario.
+Usage: python bench/scenarios.py [operators|storm|bulk ...] --zones 50 --cf-latency 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+
+import common
+from mock_telegram import BENCH_ADMIN_ID, callback_update, create_app as create_telegram_app, message_update
+
+os.environ.setdefault("ALLOWED_USERS", str(BENCH_ADMIN_ID))
+
+from aiogram.client.telegram import TelegramAPIServer
+
+import main
+from mock_cloudflare import create_app as create_cloudflare_app, start_server
+
+# What an operator mashes: (kind, payload); callbacks edit the operator's panel message
+MASH_ACTIONS = [
+    ("callback", "refresh_analytics"),
+    ("callback", "bfm_on"),
+    ("callback", "bfm_off"),
+    ("callback", "bic_on"),
+    ("callback", "bic_off"),
+    ("callback", "high"),
+    ("callback", "medium"),
+    ("button", "👁️ Показать текущий уровень"),
+    ("button", "🔒 Anti-DDoS"),
+    ("button", "📊 Показать аналитику"),
+]
+STORM_ACTIONS = [("callback", "refresh_analytics"), ("button", "🔒 Anti-DDoS"), ("button", "👁️ Показать текущий уровень")]
+
+
+class Harness:
+    """Runs the dispatcher in polling mode against the two stub servers and tracks each update."""
+
+    def __init__(self, args):
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.sent = {}
+        self.done = {}
+        self.rng = random.Random(args.seed)
+
+    async def start(self):
+        self.cloudflare = create_cloudflare_app(self.args.cf_latency, seed=self.args.seed)
+        self.telegram = create_telegram_app(self.args.tg_latency)
+        self.cloudflare_runner, cloudflare_url = await start_server(self.cloudflare)
+        self.telegram_runner, telegram_url = await start_server(self.telegram)
+        main.cf.base_url = cloudflare_url
+        main.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+        zones = {"default": main.DEFAULT_ZONE_ID}
+        zones.update({f"zone{i}": f"bench-zone-{i}" for i in range(1, self.args.zones)})
+        main.CLOUDFLARE_ZONES.clear()
+        main.CLOUDFLARE_ZONES.update(zones)
+        main.ZONE_NAMES.update({zone_id: name for name, zone_id in zones.items()})
+        main.zones_kb_for.cache_clear()
+        main.ALLOWED_USERS.update(range(1, self.args.operators + 1))
+        main.dp.update.outer_middleware(self.track)
+        self.polling = asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False, close_bot_session=False))
+        # Let startup (warm refresh, analytics backfill) settle before measuring
+        await asyncio.sleep(1)
+
+    async def stop(self):
+        await main.dp.stop_polling()
+        await self.polling
+        await main.bot.session.close()
+        await self.cloudflare_runner.cleanup()
+        await self.telegram_runner.cleanup()
+
+    async def track(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.done[event.update_id] = time.perf_counter()
+
+    def reset(self, error_rate=0.0):
+        main.settings_cache.entries.clear()
+        main.settings_cache.warm.clear()
+        self.cloudflare["error_rate"] = error_rate
+        self.cloudflare["endpoints"].clear()
+        self.cloudflare["injected"].clear()
+        self.telegram["calls"].clear()
+        self.sent.clear()
+        self.done.clear()
+
+    def send(self, operator, kind, payload):
+        update_id = next(self.update_ids)
+        if kind == "callback":
+            update = callback_update(update_id, operator, payload, message_id=operator, text="…", user_id=operator)
+        else:
+            update = message_update(update_id, operator, payload, user_id=operator)
+        self.sent[update_id] = time.perf_counter()
+        self.telegram["updates"].put_nowait(update)
+
+    async def mash(self, operator, actions, rounds, presses):
+        """One operator: `rounds` bursts of `presses` quick presses of a random action."""
+        for _ in range(rounds):
+            kind, payload = self.rng.choice(actions)
+            for _ in range(presses):
+                self.send(operator, kind, payload)
+                await asyncio.sleep(self.rng.uniform(0, 0.02))
+            await asyncio.sleep(self.rng.uniform(0.05, 0.2))
+
+    async def wait(self, timeout=120):
+        deadline = time.perf_counter() + timeout
+        while len(self.done) < len(self.sent) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.005)
+
+    def report(self, name, started, extra=""):
+        elapsed = time.perf_counter() - started
+        latencies = [self.done[update_id] - sent for update_id, sent in self.sent.items() if update_id in self.done]
+        common.report(name, latencies, elapsed, f"updates={len(self.sent)} {extra}")
+        common.report_calls("cloudflare", self.cloudflare["endpoints"])
+        if self.cloudflare["injected"]:
+            common.report_calls("injected", self.cloudflare["injected"])
+        common.report_calls("telegram", self.telegram["calls"])
+
+
+async def operators(h, args):
+    """N operators mashing panel buttons at the same time."""
+    h.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(h.mash(operator, MASH_ACTIONS, args.rounds, args.presses) for operator in range(1, args.operators + 1)))
+    await h.wait()
+    h.report(f"{args.operators} operators mashing", started)
+
+
+async def storm(h, args):
+    """
+    Attack on every zone while operators watch the panels through a flaky API:
+    measures time to mitigate all zones and to revert once traffic calms down.
+    """
+    h.reset(args.storm_error_rate)
+    engine = main.attack_engine
+    engine.detectors.clear()
+    engine.last_seen.clear()
+    engine.previous.clear()
+    settings = h.cloudflare["settings"]
+    settings.clear()
+    h.cloudflare["attack"] = True
+    started = time.perf_counter()
+    load = asyncio.gather(*(h.mash(operator, STORM_ACTIONS, args.rounds, args.presses) for operator in range(1, args.operators + 1)))
+    await engine.poll()
+    mitigated = time.perf_counter() - started
+    protected = sum(settings.get((zone_id, "security_level")) == "under_attack" for zone_id in main.CLOUDFLARE_ZONES.values())
+    h.cloudflare["attack"] = False
+    calm_started = time.perf_counter()
+    for _ in range(10):
+        if not engine.previous:
+            break
+        # The stub serves the same minutes again, now with calm traffic
+        engine.last_seen.clear()
+        await engine.poll()
+    reverted = time.perf_counter() - calm_started
+    await load
+    await h.wait()
+    h.report(
+        "attack storm", started,
+        f"mitigated={protected}/{len(main.CLOUDFLARE_ZONES)} in {mitigated:.2f}s "
+        f"reverted={not engine.previous} in {reverted:.2f}s"
+    )
+
+
+async def bulk(h, args):
+    """Operators flipping every zone between Under Attack and off from the zones menu."""
+    h.reset()
+    settings = h.cloudflare["settings"]
+    started = time.perf_counter()
+
+    async def toggler(operator):
+        for index in range(args.rounds):
+            h.send(operator, "callback", "bulk:under_attack" if index % 2 == 0 else "bulk:essentially_off")
+            await asyncio.sleep(args.bulk_pause)
+
+    await asyncio.gather(*(toggler(operator) for operator in range(1, args.bulk_operators + 1)))
+    await h.wait()
+    levels = {settings.get((zone_id, "security_level")) for zone_id in main.CLOUDFLARE_ZONES.values()}
+    h.report(f"bulk toggle x{len(main.CLOUDFLARE_ZONES)} zones", started, f"final levels={sorted(map(str, levels))}")
+
+
+SCENARIOS = {"operators": operators, "storm": storm, "bulk": bulk}
+
+
+async def bench(args):
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    h = Harness(args)
+    await h.start()
+    try:
+        for name in args.scenarios or SCENARIOS:
+            await SCENARIOS[name](h, args)
+    finally:
+        await h.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", choices=[[], *SCENARIOS], help="scenarios to run (default: all)")
+    parser.add_argument("--zones", type=int, default=50)
+    parser.add_argument("--operators", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=10, help="bursts per operator")
+    parser.add_argument("--presses", type=int, default=5, help="quick presses per burst")
+    parser.add_argument("--bulk-operators", type=int, default=3)
+    parser.add_argument("--bulk-pause", type=float, default=0.5, help="seconds between bulk toggles of one operator")
+    parser.add_argument("--cf-latency", type=float, default=0.05, help="stub Cloudflare latency in seconds")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="stub Telegram latency in seconds")
+    parser.add_argument("--storm-error-rate", type=float, default=0.1, help="share of Cloudflare calls failing during the storm")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep bot logging enabled")
+    asyncio.run(bench(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""
+Load test: push synthetic updates into the bot in polling and webhook mode and
+measure update-to-response latency and throughput. Cloudflare and Telegram are
+both local fakes.
+Usage: python bench/webhook_load.py --updates 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import common
+from mock_telegram import BENCH_ADMIN_ID, create_app as create_telegram_app, message_update
+
+os.environ.setdefault("ALLOWED_USERS", str(BENCH_ADMIN_ID))
+os.environ.setdefault("WEBHOOK_SECRET", "bench-secret")
+
+import aiohttp
+from aiogram.client.telegram import TelegramAPIServer
+
+import main
+from mock_cloudflare import create_app as create_cloudflare_app, start_server
+
+TEXT = "👁️ Показать текущий уровень"
+
+
+def collect(telegram, sent_at, elapsed):
+    latencies = [arrived - sent_at[chat_id] for arrived, method, chat_id in telegram["responses"] if chat_id in sent_at]
+    return latencies, elapsed
+
+
+async def wait_for_responses(telegram, count, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while len(telegram["responses"]) < count and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+
+
+async def run_polling(telegram, updates):
+    telegram["responses"].clear()
+    polling = asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False, close_bot_session=False))
+    await asyncio.sleep(0.2)
+    sent_at = {}
+    start = time.perf_counter()
+    for update_id in range(1, updates + 1):
+        sent_at[update_id] = time.perf_counter()
+        telegram["updates"].put_nowait(message_update(update_id, update_id, TEXT, user_id=update_id))
+    await wait_for_responses(telegram, updates)
+    elapsed = time.perf_counter() - start
+    await main.dp.stop_polling()
+    await polling
+    return collect(telegram, sent_at, elapsed)
+
+
+async def run_webhook(telegram, updates, concurrency):
+    telegram["responses"].clear()
+    runner, base_url = await start_server(main.create_webhook_app())
+    url = base_url + main.WEBHOOK_PATH
+    headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+    semaphore = asyncio.Semaphore(concurrency)
+    sent_at = {}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=message_update(0, 0, TEXT)) as resp:
+            assert resp.status == 401, "webhook accepted an update without the secret token"
+
+        async def post(update_id):
+            async with semaphore:
+                sent_at[update_id] = time.perf_counter()
+                async with session.post(url, json=message_update(update_id, update_id, TEXT, user_id=update_id), headers=headers) as resp:
+                    await resp.read()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update_id) for update_id in range(1, updates + 1)))
+        await wait_for_responses(telegram, updates)
+        elapsed = time.perf_counter() - start
+    await runner.cleanup()
+    return collect(telegram, sent_at, elapsed)
+
+
+async def bench(args):
+    cloudflare_runner, cloudflare_url = await start_server(create_cloudflare_app(args.cf_latency))
+    telegram = create_telegram_app(args.tg_latency)
+    telegram_runner, telegram_url = await start_server(telegram)
+    main.cf.base_url = cloudflare_url
+    main.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+    # Every synthetic chat is a separate operator, so identical presses are not coalesced
+    main.ALLOWED_USERS.update(range(1, args.updates + 1))
+    try:
+        latencies, elapsed = await run_polling(telegram, args.updates)
+        common.report("polling", latencies, elapsed)
+        latencies, elapsed = await run_webhook(telegram, args.updates, args.concurrency)
+        common.report("webhook", latencies, elapsed)
+    finally:
+        await cloudflare_runner.cleanup()
+        await telegram_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel webhook POSTs")
+    parser.add_argument("--cf-latency", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.0)
+    asyncio.run(bench(parser.parse_args()))
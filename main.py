@@ -1,25 +1,319 @@
 import asyncio
 import aiohttp
+import codecs
 import datetime
+import functools
+import html
+import ipaddress
+import json
 import logging
-from aiogram import Bot, Dispatcher, types
+import os
+import re
+import random
+import sqlite3
+import time
+from array import array
+from collections import Counter, deque
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.filters import Command
-from aiogram.exceptions import TelegramNetworkError, TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # ===== Logging Setup =====
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # ===== Configuration =====
-BOT_TOKEN = "токен"
-CLOUDFLARE_ZONE_ID = "айди домена"
-CLOUDFLARE_API_KEY = "ключ"
-CLOUDFLARE_EMAIL = "почта"
-ALLOWED_USERS = [124555, 12354]
+BOT_TOKEN = os.getenv("BOT_TOKEN", "токен")
+# Optional Bot API server, e.g. a local telegram-bot-api instance
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# "polling" or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL Telegram posts to, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Access control trusts from_user.id, so an unauthenticated webhook would let anyone act as an admin
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET is required when BOT_MODE=webhook")
+# Updates handled at the same time, in both modes
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "50"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
+# Prometheus metrics endpoint, served on http://METRICS_HOST:METRICS_PORT/metrics (port 0 disables it)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))  # 9090 is the Prometheus server's own port
+# Share of analytics responses written to the debug log
+ANALYTICS_LOG_SAMPLE_RATE = float(os.getenv("ANALYTICS_LOG_SAMPLE_RATE", "0.01"))
+CLOUDFLARE_ZONE_ID = os.getenv("CLOUDFLARE_ZONE_ID", "айди домена")
+CLOUDFLARE_API_KEY = os.getenv("CLOUDFLARE_API_KEY", "ключ")
+CLOUDFLARE_EMAIL = os.getenv("CLOUDFLARE_EMAIL", "почта")
+CLOUDFLARE_API_URL = os.getenv("CLOUDFLARE_API_URL", "https://api.cloudflare.com/client/v4")
+CLOUDFLARE_POOL_SIZE = int(os.getenv("CLOUDFLARE_POOL_SIZE", "20"))
+CLOUDFLARE_TIMEOUT = float(os.getenv("CLOUDFLARE_TIMEOUT", "10"))
+# Request governor: retries with jittered exponential backoff and a circuit breaker
+CLOUDFLARE_READ_RETRIES = int(os.getenv("CLOUDFLARE_READ_RETRIES", "3"))
+CLOUDFLARE_WRITE_RETRIES = int(os.getenv("CLOUDFLARE_WRITE_RETRIES", "6"))
+CLOUDFLARE_BACKOFF_BASE = float(os.getenv("CLOUDFLARE_BACKOFF_BASE", "0.5"))
+CLOUDFLARE_BACKOFF_MAX = float(os.getenv("CLOUDFLARE_BACKOFF_MAX", "10"))
+CLOUDFLARE_WRITE_DEADLINE = float(os.getenv("CLOUDFLARE_WRITE_DEADLINE", "60"))  # seconds an interactive write may spend retrying
+CLOUDFLARE_BREAKER_THRESHOLD = int(os.getenv("CLOUDFLARE_BREAKER_THRESHOLD", "5"))
+CLOUDFLARE_BREAKER_RESET = float(os.getenv("CLOUDFLARE_BREAKER_RESET", "30"))
+STATUS_FIELD_TIMEOUT = float(os.getenv("STATUS_FIELD_TIMEOUT", "3"))
+# Seconds a zone setting read stays fresh in the in-process cache
+SETTINGS_CACHE_TTL = {
+    "security_level": float(os.getenv("CACHE_TTL_SECURITY_LEVEL", "30")),
+    "bot_fight_mode": float(os.getenv("CACHE_TTL_BOT_FIGHT_MODE", "60")),
+    "browser_check": float(os.getenv("CACHE_TTL_BROWSER_CHECK", "60")),
+}
+def parse_zones(value):
+    """Parse "name=zone_id,..." into a name -> zone id dict, failing with a clear message on bad entries."""
+    zones = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        name, separator, zone_id = (part.strip() for part in item.partition("="))
+        if not separator or not name or not zone_id:
+            raise ValueError(f"CLOUDFLARE_ZONES: expected name=zone_id, got {item!r}")
+        zones[name] = zone_id
+    return zones
 
-bot = Bot(BOT_TOKEN)
+# Zone registry, display name -> zone id: CLOUDFLARE_ZONES="site1=zoneid1,site2=zoneid2"
+CLOUDFLARE_ZONES = parse_zones(os.getenv("CLOUDFLARE_ZONES", "")) or {"default": CLOUDFLARE_ZONE_ID}
+DEFAULT_ZONE_ID = next(iter(CLOUDFLARE_ZONES.values()))
+ZONE_NAMES = {zone_id: name for name, zone_id in CLOUDFLARE_ZONES.items()}
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))
+ACCESS_RULES_CONCURRENCY = int(os.getenv("ACCESS_RULES_CONCURRENCY", "20"))
+ACCESS_RULES_MAX_JOBS = int(os.getenv("ACCESS_RULES_MAX_JOBS", "1"))  # imports running at once, across all users
+ACCESS_RULES_INDEX_TTL = float(os.getenv("ACCESS_RULES_INDEX_TTL", "300"))
+ACCESS_RULES_PAGE_SIZE = 1000
+ACCESS_RULES_MAX_SPLIT = 256  # largest number of rules one CIDR may expand into
+ACCESS_RULES_PROGRESS_INTERVAL = 2  # seconds between progress edits of a running import
+# Token bucket for all API calls, tuned below Cloudflare's 1200 requests / 5 minutes per user
+CLOUDFLARE_RATE_LIMIT = float(os.getenv("CLOUDFLARE_RATE_LIMIT", "3.8"))
+CLOUDFLARE_RATE_BURST = int(os.getenv("CLOUDFLARE_RATE_BURST", "60"))
+CLOUDFLARE_RATE_RESERVE = int(os.getenv("CLOUDFLARE_RATE_RESERVE", "20"))  # tokens background jobs leave for interactive calls
+# Analytics: rolling window size and how often the newest hour bucket is polled
+ANALYTICS_WINDOW_HOURS = 24
+ANALYTICS_POLL_INTERVAL = float(os.getenv("ANALYTICS_POLL_INTERVAL", "60"))
+ANALYTICS_TOP_LIMIT = 5
+# Automatic mitigation: per-minute traffic is checked every ATTACK_POLL_INTERVAL seconds
+AUTO_MITIGATION = os.getenv("AUTO_MITIGATION", "0") == "1"
+ATTACK_POLL_INTERVAL = float(os.getenv("ATTACK_POLL_INTERVAL", "60"))
+ATTACK_WINDOW_MINUTES = int(os.getenv("ATTACK_WINDOW_MINUTES", "5"))
+ATTACK_REQUEST_RATE = float(os.getenv("ATTACK_REQUEST_RATE", "5000"))  # requests per minute
+ATTACK_THREAT_RATIO = float(os.getenv("ATTACK_THREAT_RATIO", "0.2"))
+ATTACK_ORIGIN_RATIO = float(os.getenv("ATTACK_ORIGIN_RATIO", "0.95"))
+ATTACK_MIN_RATE = float(os.getenv("ATTACK_MIN_RATE", "300"))  # ratios are ignored below this rate
+ATTACK_CALM_FACTOR = float(os.getenv("ATTACK_CALM_FACTOR", "0.5"))
+ATTACK_ESCALATE_AFTER = int(os.getenv("ATTACK_ESCALATE_AFTER", "2"))
+ATTACK_DEESCALATE_AFTER = int(os.getenv("ATTACK_DEESCALATE_AFTER", "15"))
+ATTACK_INGEST_LAG_MINUTES = int(os.getenv("ATTACK_INGEST_LAG_MINUTES", "2"))  # newest minutes are still being counted
+# SQLite file with the audit log and the last known settings/analytics; empty disables it
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1"))
+ALLOWED_USERS = {int(user_id) for user_id in os.getenv("ALLOWED_USERS", "124555,12354").split(",") if user_id.strip()}
+# Handlers that talk to Cloudflare running at once, across all users
+CLOUDFLARE_ACTION_CONCURRENCY = int(os.getenv("CLOUDFLARE_ACTION_CONCURRENCY", "10"))
+EDIT_DEBOUNCE = float(os.getenv("EDIT_DEBOUNCE", "0.3"))  # seconds between consecutive edits of one message
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+if TELEGRAM_API_URL:
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
 
+class UpdateConcurrencyMiddleware(BaseMiddleware):
+    """Caps the number of updates handled at once and lets shutdown wait for in-flight ones."""
+
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.active += 1
+        self.idle.clear()
+        try:
+            async with self.semaphore:
+                return await handler(event, data)
+        finally:
+            self.active -= 1
+            if not self.active:
+                self.idle.set()
+
+    async def drain(self, timeout):
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Shutdown with {self.active} updates still in flight")
+
+update_limiter = UpdateConcurrencyMiddleware(UPDATE_CONCURRENCY)
+dp.update.outer_middleware(update_limiter)
+
+# ===== Metrics =====
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """
+    Minimal in-process Prometheus registry: counters and latency histograms
+    keyed by (name, labels), rendered in the text exposition format.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = []
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [array("q", [0] * len(self.buckets)), 0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        samples = {}
+        for (name, labels), value in self.counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in self.histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        output = []
+        for name, lines in samples.items():
+            if name in self.help:
+                kind, text = self.help[name]
+                output.append(f"# HELP {name} {text}")
+                output.append(f"# TYPE {name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+metrics = Metrics()
+metrics.describe("cloudflare_request_duration_seconds", "histogram", "Cloudflare API request latency per attempt")
+metrics.describe("cloudflare_retries_total", "counter", "Cloudflare API requests retried by the governor")
+metrics.describe("bot_handler_duration_seconds", "histogram", "Update handler latency by action")
+metrics.describe("bot_handler_errors_total", "counter", "Update handler exceptions by action")
+metrics.describe("telegram_request_duration_seconds", "histogram", "Telegram Bot API call latency")
+metrics.describe("telegram_errors_total", "counter", "Failed Telegram Bot API calls")
+metrics.describe("settings_cache_events_total", "counter", "Zone settings cache lookups by result")
+metrics.describe("bot_updates_in_flight", "gauge", "Updates currently being handled")
+metrics.describe("cloudflare_circuit_open", "gauge", "1 while the Cloudflare circuit breaker is open")
+metrics.describe("bot_updates_coalesced_total", "counter", "Repeated presses that joined an action already in flight")
+metrics.describe("telegram_edits_coalesced_total", "counter", "Message edits superseded by a newer edit before being sent")
+metrics.describe("state_store_pending_writes", "gauge", "State store rows waiting for the next flush")
+
+def cloudflare_endpoint(path):
+    """Collapse zone and rule ids and drop the query so endpoint labels stay low-cardinality."""
+    path = re.sub(r"^/zones/[^/]+", "/zones/{zone_id}", path.split("?", 1)[0])
+    return re.sub(r"/access_rules/rules/[^/]+$", "/access_rules/rules/{rule_id}", path)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            metrics.inc("telegram_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("telegram_request_duration_seconds", time.perf_counter() - started, method=name)
+
+def action_label(event):
+    if isinstance(event, CallbackQuery):
+        return (event.data or "").split(":", 1)[0] or "empty"
+    text = event.text or ""
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    return text if text in {button.text for row in main_kb.keyboard for button in row} else "other"
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, handler_name):
+        self.handler_name = handler_name
+
+    async def __call__(self, handler, event, data):
+        action = action_label(event)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=self.handler_name, action=action)
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", time.perf_counter() - started, handler=self.handler_name, action=action)
+
+bot.session.middleware(TelegramMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware("handle_buttons"))
+dp.callback_query.middleware(HandlerMetricsMiddleware("callbacks"))
+
+async def metrics_view(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+class MetricsServer:
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        if not self.port or self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_view)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as e:
+            # Metrics are optional: a busy port must not keep the bot from starting
+            logging.error(f"Metrics server failed to start on {self.host}:{self.port}: {str(e)}")
+            await self.runner.cleanup()
+            self.runner = None
+            return
+        logging.info(f"Metrics available on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics_server = MetricsServer()
+
 # ===== Keyboards =====
 main_kb = ReplyKeyboardMarkup(
     keyboard=[
@@ -32,7 +326,8 @@ main_kb = ReplyKeyboardMarkup(
             KeyboardButton(text="📊 Показать аналитику")
         ],
         [
-            KeyboardButton(text="🔒 Anti-DDoS")
+            KeyboardButton(text="🔒 Anti-DDoS"),
+            KeyboardButton(text="🌐 Зоны")
         ]
     ],
     resize_keyboard=True
@@ -64,322 +359,1800 @@ analytics_kb = InlineKeyboardMarkup(
     ]
 )
 
-# ===== Cloudflare API Functions =====
-async def get_security_level():
-    url = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/settings/security_level"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
-    }
-    async with aiohttp.ClientSession() as session:
+# ===== Cloudflare API Client =====
+class RateLimiter:
+    """
+    Token bucket: `rate` tokens per second with bursts of up to `burst`.
+    Background callers only take a token while more than `reserve` are left
+    and wait without holding the lock, so interactive calls always go first.
+    """
+
+    def __init__(self, rate, burst, reserve=0):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, background=False):
+        if background:
+            while True:
+                async with self.lock:
+                    self.refill()
+                    if self.tokens >= 1 + self.reserve:
+                        self.tokens -= 1
+                        return
+                    wait = (1 + self.reserve - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+        async with self.lock:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects reads for
+    `reset_timeout` seconds; after that a single read is let through as a
+    probe (half-open): its success closes the breaker, its failure keeps it
+    open for another `reset_timeout`.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def allow(self, probe=False):
+        if self.opened_at is None or probe:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # A probe that never reported back (e.g. cancelled) expires after reset_timeout
+        if self.probe_at is not None and now - self.probe_at < self.reset_timeout:
+            return False
+        self.probe_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_throttled(self):
+        """The API answered but asked to slow down: neither a failure nor a reason to close."""
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_at = None
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logging.warning(f"Cloudflare circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+class CloudflareUnavailable(aiohttp.ClientError):
+    pass
+
+class CloudflareBadResponse(aiohttp.ClientError):
+    """The API answered with something other than a JSON object (e.g. an HTML error page)."""
+
+def describe_api_error(status, data):
+    """Short operator-facing description of a failed API response."""
+    if isinstance(data, dict) and data.get("errors"):
+        return f"{status} - {data['errors'][0].get('message', 'Неизвестная ошибка')}"
+    if status == 429:
+        return f"{status} - превышен лимит запросов Cloudflare, попробуйте позже"
+    if status >= 500:
+        return f"{status} - Cloudflare временно недоступен, попробуйте позже"
+    return str(status)
+
+class CloudflareClient:
+    """
+    Long-lived Cloudflare API client sharing one keep-alive connection pool.
+    Created on bot startup and closed when the Dispatcher shuts down.
+
+    Every request goes through the governor: a token bucket under the
+    per-user API limit, retries with jittered exponential backoff that honour
+    Retry-After in full, and a circuit breaker. Reads (GET and GraphQL POST)
+    retry on any transient error, give up when Retry-After exceeds
+    backoff_max and fail fast while the breaker is open. Writes
+    (every other POST, PATCH, PUT and DELETE) get more attempts, skip the
+    ambiguous 500 and are always let through as probes, since a lost "under_attack" costs far more than a
+    wasted request.
+    """
+
+    READ_RETRY_STATUSES = {429, 500, 502, 503, 504}
+    WRITE_RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, email, api_key, base_url=CLOUDFLARE_API_URL, pool_size=CLOUDFLARE_POOL_SIZE,
+                 timeout=CLOUDFLARE_TIMEOUT, dns_ttl=300, keepalive_timeout=60,
+                 read_retries=CLOUDFLARE_READ_RETRIES, write_retries=CLOUDFLARE_WRITE_RETRIES,
+                 backoff_base=CLOUDFLARE_BACKOFF_BASE, backoff_max=CLOUDFLARE_BACKOFF_MAX,
+                 write_deadline=CLOUDFLARE_WRITE_DEADLINE):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {
+            "X-Auth-Email": email,
+            "X-Auth-Key": api_key,
+            "Content-Type": "application/json"
+        }
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.read_retries = read_retries
+        self.write_retries = write_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.write_deadline = write_deadline
+        self.rate_limiter = RateLimiter(CLOUDFLARE_RATE_LIMIT, CLOUDFLARE_RATE_BURST, CLOUDFLARE_RATE_RESERVE)
+        self.breaker = CircuitBreaker(CLOUDFLARE_BREAKER_THRESHOLD, CLOUDFLARE_BREAKER_RESET)
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _send(self, method, path, json):
+        session = await self.start()
+        started = time.perf_counter()
+        status = "error"
         try:
-            async with session.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    logging.error(f"Security level API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}"
-                data = await resp.json()
-                if not data.get("success"):
-                    logging.error(f"Security level API failed: {data.get('errors')}")
-                    return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
-                level = data.get("result", {}).get("value", "unknown")
-                return f"👁️ Текущий уровень защиты: <b>{level}</b>"
-        except aiohttp.ClientError as e:
-            logging.error(f"Security level connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
-
-async def set_security_level(level):
-    url = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/settings/security_level"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
-    }
+            async with session.request(method, self.base_url + path, json=json) as resp:
+                status = resp.status
+                try:
+                    body = await resp.json(content_type=None)
+                except ValueError:
+                    body = None
+                if not isinstance(body, dict):
+                    raise CloudflareBadResponse(f"некорректный ответ API ({resp.status}, {resp.content_type})")
+                return resp.status, body, resp.headers.get("Retry-After")
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise aiohttp.ServerTimeoutError(f"Timeout while requesting {method} {path}")
+        finally:
+            metrics.observe("cloudflare_request_duration_seconds", time.perf_counter() - started,
+                            method=method, endpoint=cloudflare_endpoint(path), status=status)
+
+    async def request(self, method, path, json=None, background=False):
+        """
+        Send a request and return (status, body); body is always the parsed JSON object.
+        Background requests (bulk jobs) yield the rate limit to interactive ones
+        and are never let through an open breaker. Interactive writes stop
+        retrying once the next wait would pass write_deadline, so the operator
+        gets the last error instead of an expired callback.
+        """
+        write = method != "GET" and path != "/graphql"
+        retries = self.write_retries if write else self.read_retries
+        retry_statuses = self.WRITE_RETRY_STATUSES if write else self.READ_RETRY_STATUSES
+        deadline = time.monotonic() + self.write_deadline if write and not background else None
+        for attempt in range(retries + 1):
+            if not self.breaker.allow(probe=write and not background):
+                raise CloudflareUnavailable("API временно недоступен, попробуйте позже")
+            await self.rate_limiter.acquire(background)
+            try:
+                status, body, retry_after = await self._send(method, path, json)
+            except aiohttp.ClientError as e:
+                self.breaker.record_failure()
+                delay = self.backoff(attempt)
+                if attempt == retries or (deadline is not None and time.monotonic() + delay > deadline):
+                    raise
+                logging.warning(f"Cloudflare {method} {path} failed ({str(e)}), retry {attempt + 1}/{retries} in {delay:.2f}s")
+            else:
+                if status not in retry_statuses:
+                    self.breaker.record_success()
+                    return status, body
+                if status == 429:
+                    self.breaker.record_throttled()
+                else:
+                    self.breaker.record_failure()
+                if attempt == retries:
+                    return status, body
+                delay = self.backoff(attempt, retry_after)
+                if not write and delay > self.backoff_max:
+                    # Retrying before Retry-After only burns quota; a read is not worth the wait
+                    return status, body
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    return status, body
+                logging.warning(f"Cloudflare {method} {path} returned {status}, retry {attempt + 1}/{retries} in {delay:.2f}s")
+            metrics.inc("cloudflare_retries_total", method=method, endpoint=cloudflare_endpoint(path))
+            await asyncio.sleep(delay)
+
+cf = CloudflareClient(CLOUDFLARE_EMAIL, CLOUDFLARE_API_KEY)
+
+# ===== Settings Cache =====
+def is_error_status(value):
+    return not isinstance(value, str) or value.startswith(("❌", "⏳"))
+
+class SettingsCache:
+    """
+    TTL read-through cache for zone settings keyed by (zone_id, setting).
+    Concurrent misses for one key share a single in-flight request; error
+    results are returned to the caller but never stored. Values preloaded
+    from the state snapshot are served immediately while they are refreshed
+    in the background. Every set()/invalidate() bumps the key's generation,
+    so a load that started before a write never overwrites the written value.
+    """
+
+    def __init__(self, ttls, default_ttl=30):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.entries = {}
+        self.inflight = {}
+        self.warm = set()
+        self.generations = Counter()
+        self.listeners = []
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "warm": 0}
+
+    def set(self, key, value):
+        self.generations[key] += 1
+        # Readers from now on must not join a load that started before this value
+        self.inflight.pop(key, None)
+        ttl = self.ttls.get(key[1], self.default_ttl)
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.warm.discard(key)
+        for listener in self.listeners:
+            listener(key, value)
+
+    def preload(self, key, value):
+        """Seed an already expired entry, e.g. from the state snapshot."""
+        if key not in self.entries:
+            self.entries[key] = (value, 0)
+            self.warm.add(key)
+
+    def invalidate(self, key):
+        self.generations[key] += 1
+        self.inflight.pop(key, None)
+        self.entries.pop(key, None)
+        self.warm.discard(key)
+
+    async def _load(self, key, fetcher):
+        generation = self.generations[key]
+        try:
+            value = await fetcher()
+            if generation != self.generations[key]:
+                # A write landed while this GET was in flight; its value is newer
+                entry = self.entries.get(key)
+                return entry[0] if entry is not None else value
+            if not is_error_status(value):
+                self.set(key, value)
+            return value
+        finally:
+            if generation == self.generations[key]:
+                # A failed refresh drops the snapshot value so the next read reports the error
+                self.warm.discard(key)
+            if self.inflight.get(key) is asyncio.current_task():
+                self.inflight.pop(key)
+
+    def refresh(self, key, fetcher):
+        """Start loading `key` unless a load is already in flight; returns the task."""
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, fetcher))
+            self.inflight[key] = task
+        return task
+
+    async def get_or_fetch(self, key, fetcher):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.stats["hits"] += 1
+            return entry[0]
+        if key in self.warm:
+            self.stats["warm"] += 1
+            self.refresh(key, fetcher)
+            return entry[0]
+        self.stats["stale" if entry is not None else "misses"] += 1
+        return await asyncio.shield(self.refresh(key, fetcher))
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+
+def collect_runtime_metrics():
+    for result, value in settings_cache.stats.items():
+        yield "settings_cache_events_total", {"result": result}, value
+    yield "bot_updates_in_flight", {}, update_limiter.active
+    yield "cloudflare_circuit_open", {}, int(cf.breaker.opened_at is not None)
+    yield "state_store_pending_writes", {}, len(state_store.pending)
+
+metrics.collectors.append(collect_runtime_metrics)
+
+# ===== State Store =====
+class StateStore:
+    """
+    Local SQLite database (WAL mode) with the append-only audit log and the
+    last known zone settings and analytics buckets. Callers only append rows
+    to an in-memory buffer; a background task writes the buffer in a single
+    transaction on a worker thread, so the event loop never waits on disk.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY, ts REAL, user_id INTEGER, zone_id TEXT,"
+        " setting TEXT, value TEXT, latency_ms REAL, outcome TEXT)",
+        "CREATE TABLE IF NOT EXISTS settings (zone_id TEXT, setting TEXT, value TEXT, updated_at REAL,"
+        " PRIMARY KEY (zone_id, setting))",
+        "CREATE TABLE IF NOT EXISTS analytics (zone_id TEXT, hour INTEGER, sums TEXT, updated_at REAL,"
+        " PRIMARY KEY (zone_id, hour))",
+    )
+    INSERT_AUDIT = "INSERT INTO audit (ts, user_id, zone_id, setting, value, latency_ms, outcome) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    UPSERT_SETTING = "INSERT OR REPLACE INTO settings VALUES (?, ?, ?, ?)"
+    UPSERT_ANALYTICS = "INSERT OR REPLACE INTO analytics VALUES (?, ?, ?, ?)"
+
+    def __init__(self, path, flush_interval=STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.db = None
+        self.pending = []  # (statement, params) rows waiting for the next flush
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            db.execute(statement)
+        db.commit()
+        return db
+
+    def _write(self, batch):
+        with self.db:
+            for statement, params in batch:
+                self.db.execute(statement, params)
+
+    def _snapshot(self, oldest_hour):
+        with self.db:
+            self.db.execute("DELETE FROM analytics WHERE hour < ?", (oldest_hour,))
+        settings = self.db.execute("SELECT zone_id, setting, value FROM settings").fetchall()
+        analytics = self.db.execute("SELECT zone_id, hour, sums, updated_at FROM analytics ORDER BY hour").fetchall()
+        return settings, analytics
+
+    def _recent(self, limit):
+        return self.db.execute(
+            "SELECT ts, user_id, zone_id, setting, value, latency_ms, outcome FROM audit ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    async def _run_in_thread(self, func, *args):
+        async with self.lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def open(self):
+        """Open the database and return the (settings, analytics) snapshot; empty when disabled or broken."""
+        if not self.path:
+            return [], []
+        try:
+            self.db = await asyncio.to_thread(self._open)
+            return await self._run_in_thread(self._snapshot, int(time.time()) // 3600 - ANALYTICS_WINDOW_HOURS + 1)
+        except sqlite3.Error as e:
+            logging.error(f"State store unavailable: {str(e)}")
+            self.db = None
+            return [], []
+
+    def record_action(self, user_id, zone_id, setting, value, latency, outcome):
+        if self.db is not None:
+            self.pending.append((self.INSERT_AUDIT, (time.time(), user_id, zone_id, setting, value, latency * 1000, outcome)))
+
+    def record_setting(self, key, value):
+        if self.db is not None:
+            self.pending.append((self.UPSERT_SETTING, (key[0], key[1], value, time.time())))
+
+    def record_analytics(self, zone_id, hour, sums):
+        if self.db is not None:
+            self.pending.append((self.UPSERT_ANALYTICS, (zone_id, hour, json.dumps(sums), time.time())))
+
+    async def flush(self):
+        if self.db is None or not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            await self._run_in_thread(self._write, batch)
+        except sqlite3.Error as e:
+            logging.error(f"State store write error ({len(batch)} rows dropped): {str(e)}")
+
+    async def recent_actions(self, limit=10):
+        if self.db is None:
+            return []
+        await self.flush()
+        return await self._run_in_thread(self._recent, limit)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self.db is not None and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+        if self.db is not None:
+            await self._run_in_thread(self.db.close)
+            self.db = None
+
+state_store = StateStore(STATE_DB_PATH)
+settings_cache.listeners.append(state_store.record_setting)
+
+def audited(setting):
+    """Record every call of a zone setting writer in the audit log; adds a `user_id` argument (None for automation)."""
+    def decorator(setter):
+        @functools.wraps(setter)
+        async def wrapper(value, zone_id=DEFAULT_ZONE_ID, user_id=None):
+            started = time.monotonic()
+            try:
+                result, alert = await setter(value, zone_id)
+            except Exception as e:
+                state_store.record_action(user_id, zone_id, setting, value, time.monotonic() - started, f"exception: {str(e)}")
+                raise
+            outcome = alert if is_error_status(result) else "ok"
+            state_store.record_action(user_id, zone_id, setting, value, time.monotonic() - started, outcome)
+            return result, alert
+        return wrapper
+    return decorator
+
+# ===== Cloudflare API Functions =====
+async def fetch_security_level_status(zone_id=DEFAULT_ZONE_ID, background=False):
+    try:
+        status, data = await cf.request("GET", f"/zones/{zone_id}/settings/security_level", background=background)
+        if status != 200:
+            logging.error(f"Security level API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}"
+        if not data.get("success"):
+            logging.error(f"Security level API failed: {data.get('errors')}")
+            return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
+        return data.get("result", {}).get("value", "unknown")
+    except aiohttp.ClientError as e:
+        logging.error(f"Security level connection error: {str(e)}")
+        return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
+
+async def get_security_level_status(zone_id=DEFAULT_ZONE_ID):
+    return await settings_cache.get_or_fetch((zone_id, "security_level"), lambda: fetch_security_level_status(zone_id))
+
+async def get_security_level(zone_id=DEFAULT_ZONE_ID):
+    level = await get_security_level_status(zone_id)
+    if is_error_status(level):
+        return level
+    return f"👁️ Текущий уровень защиты: <b>{level}</b>"
+
+@audited("security_level")
+async def set_security_level(level, zone_id=DEFAULT_ZONE_ID):
     payload = {"value": level}
-    async with aiohttp.ClientSession() as session:
+    try:
+        status, data = await cf.request("PATCH", f"/zones/{zone_id}/settings/security_level", json=payload)
+        if status != 200:
+            logging.error(f"Set security level API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}", f"Ошибка API: {status}"
+        if not data.get("success"):
+            logging.error(f"Set security level API failed: {data.get('errors')}")
+            return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}", f"Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
+        settings_cache.set((zone_id, "security_level"), data.get("result", {}).get("value", level))
+        return f"✅ Уровень защиты установлен: <b>{level}</b>", f"Уровень защиты установлен: {level}"
+    except aiohttp.ClientError as e:
+        logging.error(f"Set security level connection error: {str(e)}")
+        return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
+
+SPARKLINE_BARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values):
+    peak = max(values, default=0)
+    if not peak:
+        return SPARKLINE_BARS[0] * len(values)
+    return "".join(SPARKLINE_BARS[value * (len(SPARKLINE_BARS) - 1) // peak] for value in values)
+
+async def get_security_analytics(zone_id=DEFAULT_ZONE_ID):
+    store = analytics_poller.stores.get(zone_id)
+    if store is None or store.updated_at is None:
+        # Cold start: the poller has not filled the store yet
+        error = await analytics_poller.poll(ANALYTICS_WINDOW_HOURS)
+        if error:
+            return error
+        store = analytics_poller.stores.get(zone_id)
+    if store is None or store.updated_at is None:
+        logging.warning("No zones found in analytics response")
+        return "📊 Аналитика недоступна: зона не найдена.", "Аналитика недоступна: зона не найдена."
+    if store.latest_hour < 0:
+        logging.warning("No analytics data for the last 24 hours")
+        return "📊 Аналитика недоступна: данные за последние 24 часа отсутствуют.", "Аналитика недоступна: данные за последние 24 часа отсутствуют."
+    total_requests = store.totals["requests"]
+    total_threats = store.totals["threats"]
+    cached_requests = store.totals["cachedRequests"]
+    served_by_origin = total_requests - cached_requests
+    lines = [
+        "📊 Аналитика запросов (последние 24 часа):",
+        f"Всего запросов: <b>{total_requests}</b>",
+        f"Угрозы: <b>{total_threats}</b>",
+        f"Обслужено Cloudflare: <b>{cached_requests}</b>",
+        f"Обслужено сервером: <b>{served_by_origin}</b>",
+        f"Запросы по часам: <code>{sparkline(store.series('requests'))}</code>",
+        f"Угрозы по часам: <code>{sparkline(store.series('threats'))}</code>",
+    ]
+    countries = store.top("countries")
+    if countries:
+        lines.append("🌍 Топ стран: " + ", ".join(f"{html.escape(str(country))} {count}" for country, count in countries))
+    if store.top_paths:
+        lines.append("📄 Топ путей (последний час):")
+        lines += [f"  <code>{html.escape(str(path))}</code> {count}" for path, count in store.top_paths]
+    statuses = store.top("statuses")
+    if statuses and total_requests:
+        lines.append("🔢 Коды ответа: " + ", ".join(f"{code} {count * 100 / total_requests:.1f}%" for code, count in statuses))
+    lines.append(f"Обновлено: {time.strftime('%H:%M:%S', time.gmtime(store.updated_at))} UTC")
+    message = "\n".join(lines)
+    alert = f"Аналитика запросов: {total_requests} запросов, {cached_requests} обслужено Cloudflare, {served_by_origin} обслужено сервером"
+    return message, alert
+
+async def fetch_bot_fight_mode_status(zone_id=DEFAULT_ZONE_ID, background=False):
+    """
+    Get Bot Fight Mode status for Free plan.
+    WARNING: BFM may block legitimate API or mobile app traffic. Disable if issues occur.
+    See: https://developers.cloudflare.com/bots/get-started/free/
+    """
+    try:
+        status, data = await cf.request("GET", f"/zones/{zone_id}/bot_management", background=background)
+        if status != 200:
+            logging.error(f"Bot Fight Mode status API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}"
+        if not data.get("success"):
+            logging.error(f"Bot Fight Mode status API failed: {data.get('errors')}")
+            return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
+        state = data.get("result", {}).get("fight_mode", False)
+        return "on" if state is True else "off"
+    except aiohttp.ClientError as e:
+        logging.error(f"Bot Fight Mode status connection error: {str(e)}")
+        return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
+
+async def get_bot_fight_mode_status(zone_id=DEFAULT_ZONE_ID):
+    return await settings_cache.get_or_fetch((zone_id, "bot_fight_mode"), lambda: fetch_bot_fight_mode_status(zone_id))
+
+@audited("bot_fight_mode")
+async def set_bot_fight_mode(state, zone_id=DEFAULT_ZONE_ID):
+    """
+    Set Bot Fight Mode on or off for Free plan.
+    WARNING: BFM may block legitimate API or mobile app traffic. Disable if issues occur.
+    See: https://developers.cloudflare.com/bots/get-started/free/
+    """
+    payload = {"super_fight_mode": state == "on"}
+    try:
+        status, data = await cf.request("PUT", f"/zones/{zone_id}/bot_management", json=payload)
+        if status != 200:
+            logging.error(f"Bot Fight Mode API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}", f"Ошибка API: {status}"
+        if not data.get("success"):
+            logging.error(f"Set Bot Fight Mode API failed: {data.get('errors')}")
+            return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}", f"Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
+        result = data.get("result") or {}
+        if "fight_mode" in result:
+            settings_cache.set((zone_id, "bot_fight_mode"), "on" if result["fight_mode"] is True else "off")
+        else:
+            settings_cache.invalidate((zone_id, "bot_fight_mode"))
+        state_str = "включен" if state == "on" else "выключен"
+        return f"✅ Bot Fight Mode {state_str}: <b>{state}</b>", f"Bot Fight Mode {state_str}: {state}"
+    except aiohttp.ClientError as e:
+        logging.error(f"Bot Fight Mode connection error: {str(e)}")
+        return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
+
+async def fetch_browser_integrity_check_status(zone_id=DEFAULT_ZONE_ID, background=False):
+    try:
+        status, data = await cf.request("GET", f"/zones/{zone_id}/settings/browser_check", background=background)
+        if status != 200:
+            logging.error(f"Browser Integrity Check status API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}"
+        if not data.get("success"):
+            logging.error(f"Browser Integrity Check status API failed: {data.get('errors')}")
+            return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
+        state = data.get("result", {}).get("value", "unknown")
+        return state
+    except aiohttp.ClientError as e:
+        logging.error(f"Browser Integrity Check status connection error: {str(e)}")
+        return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
+
+async def get_browser_integrity_check_status(zone_id=DEFAULT_ZONE_ID):
+    return await settings_cache.get_or_fetch((zone_id, "browser_check"), lambda: fetch_browser_integrity_check_status(zone_id))
+
+@audited("browser_check")
+async def set_browser_integrity_check(state, zone_id=DEFAULT_ZONE_ID):
+    payload = {"value": state}
+    try:
+        status, data = await cf.request("PATCH", f"/zones/{zone_id}/settings/browser_check", json=payload)
+        if status != 200:
+            logging.error(f"Browser Integrity Check API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}", f"Ошибка API: {status}"
+        if not data.get("success"):
+            logging.error(f"Set Browser Integrity Check API failed: {data.get('errors')}")
+            return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}", f"Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
+        settings_cache.set((zone_id, "browser_check"), data.get("result", {}).get("value", state))
+        state_str = "включена" if state == "on" else "выключена"
+        return f"✅ Browser Integrity Check {state_str}: <b>{state}</b>", f"Browser Integrity Check {state_str}: {state}"
+    except aiohttp.ClientError as e:
+        logging.error(f"Browser Integrity Check connection error: {str(e)}")
+        return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
+
+# ===== Status Aggregation =====
+# Settings shown on the Anti-DDoS panel: key -> (label, status getter).
+# Getters return the raw value or an error string and are fetched concurrently.
+STATUS_FIELDS = {
+    "level": ("Уровень защиты", get_security_level_status),
+    "bfm": ("Bot Fight Mode", get_bot_fight_mode_status),
+    "bic": ("Browser Integrity Check", get_browser_integrity_check_status),
+}
+
+async def fetch_status_field(name, zone_id=DEFAULT_ZONE_ID, timeout=STATUS_FIELD_TIMEOUT):
+    try:
+        return await asyncio.wait_for(STATUS_FIELDS[name][1](zone_id), timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"Status field {name} timed out after {timeout}s")
+        return "⏳ нет ответа"
+    except Exception as e:
+        logging.error(f"Status field {name} error: {str(e)}")
+        return f"❌ Ошибка: {str(e)}"
+
+async def get_zone_status(zone_id=DEFAULT_ZONE_ID, fields=None, timeout=STATUS_FIELD_TIMEOUT):
+    """
+    Fetch all panel settings at once, so a render costs one round trip.
+    A slow or failing field only degrades its own line.
+    """
+    names = list(fields or STATUS_FIELDS)
+    values = await asyncio.gather(*(fetch_status_field(name, zone_id, timeout) for name in names))
+    return dict(zip(names, values))
+
+@functools.lru_cache(maxsize=256)
+def render_panel(title, zone_id, state):
+    """Render the panel for a (field, value) state tuple; identical states reuse the cached text."""
+    lines = [title]
+    if len(CLOUDFLARE_ZONES) > 1:
+        lines.append(f"Зона: <b>{html.escape(ZONE_NAMES.get(zone_id, zone_id))}</b>")
+    lines += [f"{STATUS_FIELDS[name][0]}: <b>{value}</b>" for name, value in state]
+    return "\n".join(lines)
+
+def render_anti_ddos_status(status, title="🔒 Статус Anti-DDoS:", zone_id=DEFAULT_ZONE_ID):
+    return render_panel(title, zone_id, tuple(status.items()))
+
+async def get_anti_ddos_status_message(title="🔒 Статус Anti-DDoS:", zone_id=DEFAULT_ZONE_ID):
+    return render_anti_ddos_status(await get_zone_status(zone_id), title, zone_id)
+
+# ===== Multi-zone =====
+selected_zones = {}  # user id -> zone id chosen in the zones keyboard
+
+def get_user_zone(user_id):
+    zone_id = selected_zones.get(user_id)
+    return zone_id if zone_id in ZONE_NAMES else DEFAULT_ZONE_ID
+
+async def set_security_level_bulk(level, zone_ids=None, concurrency=BULK_CONCURRENCY, user_id=None):
+    """
+    Apply a security level to many zones in parallel; returns {zone_id: (message, alert)}.
+    Requests still pass through the client's rate limiter, so bursts stay under the API limit.
+    """
+    zone_ids = list(zone_ids or CLOUDFLARE_ZONES.values())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def apply(zone_id):
+        async with semaphore:
+            return await set_security_level(level, zone_id, user_id=user_id)
+
+    results = await asyncio.gather(*(apply(zone_id) for zone_id in zone_ids))
+    return dict(zip(zone_ids, results))
+
+async def apply_security_level_to_all_zones(level, user_id=None):
+    started = time.monotonic()
+    results = await set_security_level_bulk(level, user_id=user_id)
+    failed = {zone_id: alert for zone_id, (result, alert) in results.items() if is_error_status(result)}
+    done = len(results) - len(failed)
+    lines = [f"🌐 Уровень <b>{level}</b> установлен на {done}/{len(results)} зонах за {time.monotonic() - started:.1f} с"]
+    lines += [f"❌ {html.escape(ZONE_NAMES.get(zone_id, zone_id))}: {html.escape(alert)}" for zone_id, alert in failed.items()]
+    alert = f"Уровень {level}: успешно {done}, ошибок {len(failed)}"
+    return "\n".join(lines), alert
+
+# ===== IP Access Rules =====
+# Bot command -> Cloudflare access rule mode; "unblock" deletes rules in these modes only
+ACCESS_RULE_MODES = {"block": "block", "challenge": "managed_challenge"}
+ACCESS_RULE_TITLES = {"block": "🚫 Блокировка", "challenge": "🧩 Проверка (challenge)", "unblock": "♻️ Снятие правил"}
+ACCESS_RULE_DUPLICATE_CODE = 10009  # firewallaccessrules.api.duplicate_of_existing
+# Prefix lengths Cloudflare accepts for ip_range rules
+ACCESS_RULE_PREFIXES = {4: (16, 24), 6: (32, 48, 64)}
+ASN_PATTERN = re.compile(r"ASN?(\d{1,10})", re.IGNORECASE)
+# ISO 3166-1 alpha-2 codes plus T1 (Tor); only uppercase tokens count, so stray words are rejected
+COUNTRY_CODES = frozenset("""
+    AD AE AF AG AI AL AM AO AQ AR AS AT AU AW AX AZ BA BB BD BE BF BG BH BI
+    BJ BL BM BN BO BQ BR BS BT BV BW BY BZ CA CC CD CF CG CH CI CK CL CM CN
+    CO CR CU CV CW CX CY CZ DE DJ DK DM DO DZ EC EE EG EH ER ES ET FI FJ FK
+    FM FO FR GA GB GD GE GF GG GH GI GL GM GN GP GQ GR GS GT GU GW GY HK HM
+    HN HR HT HU ID IE IL IM IN IO IQ IR IS IT JE JM JO JP KE KG KH KI KM KN
+    KP KR KW KY KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MF MG MH MK
+    ML MM MN MO MP MQ MR MS MT MU MV MW MX MY MZ NA NC NE NF NG NI NL NO NP
+    NR NU NZ OM PA PE PF PG PH PK PL PM PN PR PS PT PW PY QA RE RO RS RU RW
+    SA SB SC SD SE SG SH SI SJ SK SL SM SN SO SR SS ST SV SX SY SZ TC TD TF
+    TG TH TJ TK TL TM TN TO TR TT TV TW TZ UA UG UM US UY UZ VA VC VE VG VI
+    VN VU WF WS YE YT ZA ZM ZW
+    T1
+""".split())
+
+def access_rule_targets(network):
+    """Express a network as (target, value) rule configurations, splitting prefixes Cloudflare does not accept."""
+    if network.prefixlen == network.max_prefixlen:
+        return [("ip" if network.version == 4 else "ip6", str(network.network_address))]
+    allowed = ACCESS_RULE_PREFIXES[network.version]
+    if network.prefixlen in allowed:
+        return [("ip_range", str(network))]
+    if network.prefixlen > allowed[-1]:
+        if network.version == 6:
+            # Nothing narrower than a /64 is accepted, and a /64 is usually a single host anyway
+            return [("ip_range", str(network.supernet(new_prefix=allowed[-1])))]
+        new_prefix = network.max_prefixlen
+    else:
+        new_prefix = next(prefix for prefix in allowed if prefix > network.prefixlen)
+    if 2 ** (new_prefix - network.prefixlen) > ACCESS_RULES_MAX_SPLIT:
+        raise ValueError(f"{network}: слишком широкая сеть")
+    return [access_rule_targets(subnet)[0] for subnet in network.subnets(new_prefix=new_prefix)]
+
+def collapsed_targets(network):
+    """access_rule_targets() for a collapsed network, halving it while it is too wide to split at once."""
+    try:
+        return access_rule_targets(network)
+    except ValueError:
+        # Adjacent valid entries can collapse into a network wider than ACCESS_RULES_MAX_SPLIT allows
+        return [target for subnet in network.subnets(prefixlen_diff=1) for target in collapsed_targets(subnet)]
+
+def covering_ranges(target, value):
+    """ip_range values of every accepted prefix that contains the entry."""
+    if target not in ("ip", "ip6", "ip_range"):
+        return []
+    network = ipaddress.ip_network(value)
+    return [str(network.supernet(new_prefix=prefix)) for prefix in ACCESS_RULE_PREFIXES[network.version] if prefix < network.prefixlen]
+
+class AccessList:
+    """
+    IPs, CIDRs, ASNs and countries parsed from an operator's list, deduplicated
+    as lines stream in; only the parsed entries are kept, never the raw text.
+    Tokens are separated by whitespace, commas or semicolons; "#" starts a comment.
+    """
+
+    def __init__(self):
+        self.networks = {4: set(), 6: set()}
+        self.asns = set()
+        self.countries = set()
+        self.entries = 0
+        self.invalid = 0
+        self.samples = []  # first few rejected tokens, for the report
+
+    def reject(self, reason):
+        self.invalid += 1
+        if len(self.samples) < 5:
+            self.samples.append(reason)
+
+    def add(self, token):
+        self.entries += 1
         try:
-            async with session.patch(url, headers=headers, json=payload) as resp:
-                if resp.status != 200:
-                    logging.error(f"Set security level API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}", f"Ошибка API: {resp.status}"
-                data = await resp.json()
-                if not data.get("success"):
-                    logging.error(f"Set security level API failed: {data.get('errors')}")
-                    return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}", f"Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
-                return f"✅ Уровень защиты установлен: <b>{level}</b>", f"Уровень защиты установлен: {level}"
-        except aiohttp.ClientError as e:
-            logging.error(f"Set security level connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
-
-async def get_security_analytics():
-    url = "https://api.cloudflare.com/client/v4/graphql"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
+            network = ipaddress.ip_network(token, strict=False)
+        except ValueError:
+            pass
+        else:
+            try:
+                access_rule_targets(network)
+            except ValueError as e:
+                # Rejected here, before collapsing could merge it with the valid entries
+                self.reject(str(e))
+            else:
+                self.networks[network.version].add(network)
+            return
+        match = ASN_PATTERN.fullmatch(token)
+        if match:
+            self.asns.add(int(match.group(1)))
+        elif token in COUNTRY_CODES:
+            self.countries.add(token)
+        else:
+            self.reject(token)
+
+    def add_line(self, line):
+        for token in re.split(r"[\s,;]+", line.split("#", 1)[0]):
+            if token:
+                self.add(token)
+
+    def targets(self):
+        """Yield (target, value) rule configurations with overlapping CIDRs collapsed."""
+        for version in (4, 6):
+            for network in ipaddress.collapse_addresses(self.networks[version]):
+                yield from collapsed_targets(network)
+        for asn in sorted(self.asns):
+            yield "asn", f"AS{asn}"
+        for country in sorted(self.countries):
+            yield "country", country
+
+async def file_chunks(file_path, chunk_size=65536):
+    """Stream a Telegram file in chunks, from a local Bot API server's disk or over HTTP."""
+    if bot.session.api.is_local:
+        with open(bot.session.api.wrap_local_file.to_local(file_path), "rb") as local_file:
+            while chunk := await asyncio.to_thread(local_file.read, chunk_size):
+                yield chunk
+    else:
+        async for chunk in bot.session.stream_content(url=bot.session.api.file_url(bot.token, file_path), chunk_size=chunk_size):
+            yield chunk
+
+async def document_lines(document):
+    """Yield the lines of an uploaded document without downloading it whole."""
+    file = await bot.get_file(document.file_id)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")("replace")
+    tail = ""
+    async for chunk in file_chunks(file.file_path):
+        lines = (tail + decoder.decode(chunk)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+class AccessRuleIndex:
+    """
+    Local copy of a zone's IP Access Rules keyed by (target, value), built from
+    paginated GETs and kept in sync with the bot's own changes; it is reloaded
+    once older than ACCESS_RULES_INDEX_TTL.
+    """
+
+    def __init__(self, zone_id):
+        self.zone_id = zone_id
+        self.rules = {}  # (target, value) -> (rule id, mode)
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+
+    async def fetch_page(self, page):
+        """Returns (rules, result_info) or (error message, None)."""
+        status, data = await cf.request(
+            "GET", f"/zones/{self.zone_id}/firewall/access_rules/rules?page={page}&per_page={ACCESS_RULES_PAGE_SIZE}", background=True
+        )
+        if status != 200 or not data.get("success"):
+            logging.error(f"Access rules list API error: {status} - {data}")
+            return f"❌ Ошибка API: {describe_api_error(status, data)}", None
+        return data.get("result") or [], data.get("result_info") or {}
+
+    async def load(self):
+        """Reload the index unless it is fresh; returns an error message or None."""
+        async with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < ACCESS_RULES_INDEX_TTL:
+                return None
+            semaphore = asyncio.Semaphore(ACCESS_RULES_CONCURRENCY)
+
+            async def fetch(page):
+                async with semaphore:
+                    return await self.fetch_page(page)
+
+            try:
+                first, info = await self.fetch_page(1)
+                if info is None:
+                    return first
+                pages = [(first, info)]
+                # The first page tells how many there are; the rest are fetched in parallel
+                pages += await asyncio.gather(*(fetch(page) for page in range(2, (info.get("total_pages") or 1) + 1)))
+            except aiohttp.ClientError as e:
+                logging.error(f"Access rules connection error: {str(e)}")
+                return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
+            rules = {}
+            for result, info in pages:
+                if info is None:
+                    return result
+                for rule in result:
+                    configuration = rule.get("configuration") or {}
+                    rules[(configuration.get("target"), configuration.get("value"))] = (rule["id"], rule.get("mode"))
+            self.rules = rules
+            self.loaded_at = time.monotonic()
+            return None
+
+access_rule_indexes = {}  # zone id -> AccessRuleIndex
+# Imports are not registry actions, so CLOUDFLARE_ACTION_CONCURRENCY does not cover them
+access_rule_jobs = asyncio.Semaphore(ACCESS_RULES_MAX_JOBS)
+
+class AccessRuleJob:
+    """
+    One /block, /challenge or /unblock run against a zone. Entries are
+    compared with the zone's index and only the difference is sent, by a
+    fixed number of workers pulling from the shared targets iterator.
+    """
+
+    def __init__(self, zone_id, command, user_id=None):
+        self.zone_id = zone_id
+        self.command = command
+        self.mode = ACCESS_RULE_MODES.get(command)
+        self.user_id = user_id
+        self.counts = Counter()
+        self.errors = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    def fail(self, error):
+        self.counts["failed"] += 1
+        if len(self.errors) < 3:
+            self.errors.append(error)
+
+    async def apply(self, index, target, value):
+        base = f"/zones/{self.zone_id}/firewall/access_rules/rules"
+        key = (target, value)
+        existing = index.rules.get(key)
+        if self.mode is None:
+            if existing is None:
+                self.counts["missing"] += 1
+                return
+            if existing[1] not in ACCESS_RULE_MODES.values():
+                # e.g. a whitelist rule made in the dashboard: not something the bot blocks, leave it
+                self.counts["foreign"] += 1
+                return
+            status, data = await cf.request("DELETE", f"{base}/{existing[0]}", background=True)
+            result = "deleted"
+        elif existing is None:
+            if any(index.rules.get(("ip_range", network), (None, None))[1] == self.mode for network in covering_ranges(target, value)):
+                self.counts["unchanged"] += 1
+                return
+            payload = {"mode": self.mode, "configuration": {"target": target, "value": value}, "notes": f"cloudflare-control-bot, user {self.user_id}"}
+            status, data = await cf.request("POST", base, json=payload, background=True)
+            result = "created"
+        elif existing[1] == self.mode:
+            self.counts["unchanged"] += 1
+            return
+        else:
+            status, data = await cf.request("PATCH", f"{base}/{existing[0]}", json={"mode": self.mode}, background=True)
+            result = "updated"
+        if result == "created" and any(error.get("code") == ACCESS_RULE_DUPLICATE_CODE for error in data.get("errors") or []):
+            # Usually our own POST retried after a lost response; the index lacks its id until the next reload
+            index.loaded_at = None
+            self.counts["unchanged"] += 1
+            return
+        if result == "deleted" and status == 404:
+            # Already gone, e.g. a retried DELETE whose first attempt succeeded
+            status, data = 200, {"success": True}
+        if status != 200 or not data.get("success"):
+            logging.error(f"Access rule API error for {target} {value}: {status} - {data}")
+            self.fail(f"❌ {html.escape(value)}: {describe_api_error(status, data)}")
+            return
+        if result == "deleted":
+            index.rules.pop(key, None)
+        else:
+            index.rules[key] = ((data.get("result") or {}).get("id", existing and existing[0]), self.mode)
+        self.counts[result] += 1
+
+    async def run(self, targets, concurrency=ACCESS_RULES_CONCURRENCY):
+        index = access_rule_indexes.setdefault(self.zone_id, AccessRuleIndex(self.zone_id))
+        error = await index.load()
+        if error:
+            self.errors.append(error)
+            return
+
+        async def worker():
+            for target, value in targets:
+                try:
+                    await self.apply(index, target, value)
+                except CloudflareUnavailable as e:
+                    # The breaker is open: stop this worker instead of failing every remaining entry
+                    self.fail(f"❌ Ошибка соединения с Cloudflare: {str(e)}")
+                    return
+                except aiohttp.ClientError as e:
+                    self.fail(f"❌ Ошибка соединения с Cloudflare: {str(e)}")
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    def render(self, entries):
+        finished = self.finished is not None
+        counts = self.counts
+        lines = [
+            f"{'✅' if finished and not self.errors else '❌' if finished else '⏳'} {ACCESS_RULE_TITLES[self.command]} "
+            f"в зоне <b>{html.escape(ZONE_NAMES.get(self.zone_id, self.zone_id))}</b>",
+            f"Записей в списке: <b>{entries.entries}</b>, некорректных: <b>{entries.invalid}</b>",
+        ]
+        if self.mode is None:
+            lines.append(
+                f"Удалено: <b>{counts['deleted']}</b>, не найдено: <b>{counts['missing']}</b>, "
+                f"оставлено правил с другим режимом: <b>{counts['foreign']}</b>, ошибок: <b>{counts['failed']}</b>"
+            )
+        else:
+            lines.append(
+                f"Создано: <b>{counts['created']}</b>, изменено: <b>{counts['updated']}</b>, "
+                f"уже действуют: <b>{counts['unchanged']}</b>, ошибок: <b>{counts['failed']}</b>"
+            )
+        lines.append(f"Время: {(self.finished or time.monotonic()) - self.started:.1f} с")
+        lines += [f"Пропущено: <code>{html.escape(sample)}</code>" for sample in entries.samples]
+        lines += self.errors
+        return "\n".join(lines)
+
+# ===== Analytics Poller =====
+class AnalyticsStore:
+    """
+    Fixed-size ring buffer of hourly analytics buckets for one zone.
+    Slot i holds hour number (unix time // 3600) h with h % size == i; rolling
+    totals are adjusted on every merge so reads are O(1).
+    """
+
+    METRICS = ("requests", "threats", "cachedRequests")
+    # breakdown name -> (map field in the GraphQL sum, dimension key)
+    BREAKDOWNS = {
+        "countries": ("countryMap", "clientCountryName"),
+        "statuses": ("responseStatusMap", "edgeResponseStatus"),
     }
-    now = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-    past_24h = (datetime.datetime.utcnow() - datetime.timedelta(hours=24)).replace(microsecond=0).isoformat() + "Z"
-    
-    query = """
-    query {
-        viewer {
-            zones(filter: {zoneTag: "%s"}) {
-                httpRequests1hGroups(
-                    limit: 24
-                    filter: { datetime_geq: "%s", datetime_leq: "%s" }
-                    orderBy: [datetime_DESC]
-                ) {
-                    sum {
-                        requests
-                        threats
-                        cachedRequests
+
+    def __init__(self, size=ANALYTICS_WINDOW_HOURS):
+        self.size = size
+        self.hours = array("q", [-1] * size)
+        self.values = {metric: array("q", [0] * size) for metric in self.METRICS}
+        self.totals = dict.fromkeys(self.METRICS, 0)
+        self.breakdowns = {name: [None] * size for name in self.BREAKDOWNS}
+        self.breakdown_totals = {name: Counter() for name in self.BREAKDOWNS}
+        self.top_paths = []
+        self.latest_hour = -1
+        self.updated_at = None
+
+    def _clear_slot(self, slot):
+        for metric in self.METRICS:
+            self.totals[metric] -= self.values[metric][slot]
+            self.values[metric][slot] = 0
+        for name, slots in self.breakdowns.items():
+            if slots[slot]:
+                self.breakdown_totals[name].subtract(slots[slot])
+            slots[slot] = None
+        self.hours[slot] = -1
+
+    def advance(self, hour):
+        """Move the window forward to `hour`, expiring buckets that fell out of it."""
+        if hour <= self.latest_hour:
+            return
+        for expired in range(max(self.latest_hour + 1, hour - self.size + 1), hour + 1):
+            self._clear_slot(expired % self.size)
+        self.latest_hour = hour
+
+    def merge(self, hour, sums):
+        if hour <= self.latest_hour - self.size:
+            return
+        self.advance(hour)
+        slot = hour % self.size
+        if self.hours[slot] != hour:
+            self._clear_slot(slot)
+            self.hours[slot] = hour
+        for metric in self.METRICS:
+            value = sums.get(metric) or 0
+            self.totals[metric] += value - self.values[metric][slot]
+            self.values[metric][slot] = value
+        for name, (field, key) in self.BREAKDOWNS.items():
+            counts = {}
+            for item in sums.get(field) or []:
+                counts[item[key]] = counts.get(item[key], 0) + (item.get("requests") or 0)
+            previous = self.breakdowns[name][slot]
+            if previous:
+                self.breakdown_totals[name].subtract(previous)
+            self.breakdown_totals[name].update(counts)
+            self.breakdowns[name][slot] = counts
+
+    def series(self, metric):
+        """Hourly values for the window, oldest first."""
+        values = self.values[metric]
+        return [
+            values[hour % self.size] if self.hours[hour % self.size] == hour else 0
+            for hour in range(self.latest_hour - self.size + 1, self.latest_hour + 1)
+        ]
+
+    def top(self, name, limit=5):
+        return [(key, count) for key, count in self.breakdown_totals[name].most_common(limit) if count > 0]
+
+class AnalyticsPoller:
+    """
+    Background task that keeps an AnalyticsStore per zone up to date. The
+    first poll backfills the whole window; later polls only fetch the newest
+    hour bucket plus the previous one, so late data for it is still merged.
+    """
+
+    def __init__(self, interval=ANALYTICS_POLL_INTERVAL):
+        self.interval = interval
+        self.stores = {}
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    async def poll(self, hours=2):
+        """Fetch the newest `hours` buckets for every zone; returns an error (message, alert) or None."""
+        zone_ids = list(CLOUDFLARE_ZONES.values())
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        since = now.replace(minute=0, second=0) - datetime.timedelta(hours=hours - 1)
+        last_hour = now - datetime.timedelta(hours=1)
+        # One request for every dataset: hourly sums with country/status maps and top paths
+        query = """
+        query {
+            viewer {
+                zones(filter: {zoneTag_in: [%s]}) {
+                    zoneTag
+                    hourly: httpRequests1hGroups(
+                        limit: %d
+                        filter: { datetime_geq: "%s", datetime_leq: "%s" }
+                        orderBy: [datetime_DESC]
+                    ) {
+                        sum {
+                            requests
+                            threats
+                            cachedRequests
+                            countryMap {
+                                clientCountryName
+                                requests
+                            }
+                            responseStatusMap {
+                                edgeResponseStatus
+                                requests
+                            }
+                        }
+                        dimensions {
+                            datetime
+                        }
                     }
-                    dimensions {
-                        datetime
+                    topPaths: httpRequestsAdaptiveGroups(
+                        limit: %d
+                        filter: { datetime_geq: "%s", datetime_leq: "%s" }
+                        orderBy: [count_DESC]
+                    ) {
+                        count
+                        dimensions {
+                            clientRequestPath
+                        }
                     }
                 }
             }
         }
-    }
-    """ % (CLOUDFLARE_ZONE_ID, past_24h, now)
-    
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(url, headers=headers, json={"query": query}) as resp:
-                if resp.status != 200:
-                    logging.error(f"Analytics API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}", f"Ошибка API: {resp.status}"
-                data = await resp.json()
-                logging.info(f"Analytics API response: {data}")
+        """ % (
+            ", ".join(f'"{zone_id}"' for zone_id in zone_ids), hours, since.isoformat() + "Z", now.isoformat() + "Z",
+            ANALYTICS_TOP_LIMIT, last_hour.isoformat() + "Z", now.isoformat() + "Z"
+        )
+
+        async with self.lock:
+            try:
+                status, data = await cf.request("POST", "/graphql", json={"query": query})
+                if status != 200:
+                    logging.error(f"Analytics API error: {status} - {data}")
+                    return f"❌ Ошибка API: {describe_api_error(status, data)}", f"Ошибка API: {status}"
+                if random.random() < ANALYTICS_LOG_SAMPLE_RATE and logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(f"Analytics API response: {data}")
                 errors = data.get("errors")
                 if errors:
                     logging.error(f"GraphQL error: {errors}")
                     return f"❌ Ошибка GraphQL: {errors[0].get('message', 'Неизвестная ошибка')}", f"Ошибка GraphQL: {errors[0].get('message', 'Неизвестная ошибка')}"
-                zones = data.get("data", {}).get("viewer", {}).get("zones", [])
-                if not zones:
-                    logging.warning("No zones found in analytics response")
-                    return "📊 Аналитика недоступна: зона не найдена.", "Аналитика недоступна: зона не найдена."
-                http_requests = zones[0].get("httpRequests1hGroups", [])
-                if not http_requests:
-                    logging.warning("No analytics data for the last 24 hours")
-                    return "📊 Аналитика недоступна: данные за последние 24 часа отсутствуют.", "Аналитика недоступна: данные за последние 24 часа отсутствуют."
-                total_requests = sum(group["sum"]["requests"] for group in http_requests)
-                total_threats = sum(group["sum"]["threats"] for group in http_requests)
-                cached_requests = sum(group["sum"]["cachedRequests"] for group in http_requests)
-                served_by_origin = total_requests - cached_requests
-                message = (
-                    f"📊 Аналитика запросов (последние 24 часа):\n"
-                    f"Всего запросов: <b>{total_requests}</b>\n"
-                    f"Обслужено Cloudflare: <b>{cached_requests}</b>\n"
-                    f"Обслужено сервером: <b>{served_by_origin}</b>"
-                )
-                alert = f"Аналитика запросов: {total_requests} запросов, {cached_requests} обслужено Cloudflare, {served_by_origin} обслужено сервером"
-                return message, alert
-        except aiohttp.ClientError as e:
-            logging.error(f"Analytics connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
+            except aiohttp.ClientError as e:
+                logging.error(f"Analytics connection error: {str(e)}")
+                return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
+
+            current_hour = int(time.time()) // 3600
+            for zone in (data.get("data") or {}).get("viewer", {}).get("zones", []):
+                store = self.stores.setdefault(zone.get("zoneTag"), AnalyticsStore())
+                for group in zone.get("hourly") or []:
+                    started = datetime.datetime.fromisoformat(group["dimensions"]["datetime"].replace("Z", "+00:00"))
+                    hour = int(started.timestamp()) // 3600
+                    store.merge(hour, group["sum"])
+                    state_store.record_analytics(zone.get("zoneTag"), hour, group["sum"])
+                store.top_paths = [(group["dimensions"]["clientRequestPath"], group["count"]) for group in zone.get("topPaths") or []]
+                store.advance(current_hour)
+                store.updated_at = time.time()
+            return None
+
+    async def run(self):
+        hours = ANALYTICS_WINDOW_HOURS
+        while True:
+            try:
+                # Keep backfilling the whole window until a poll succeeds
+                if await self.poll(hours) is None:
+                    hours = 2
+            except Exception as e:
+                logging.error(f"Analytics poller error: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
 
-async def get_bot_fight_mode_status():
+analytics_poller = AnalyticsPoller()
+
+# ===== Attack Detection =====
+# metric -> escalation threshold; a threshold of 0 disables the rule
+ATTACK_RULES = {
+    "request_rate": ATTACK_REQUEST_RATE,
+    "threat_ratio": ATTACK_THREAT_RATIO,
+    "origin_ratio": ATTACK_ORIGIN_RATIO,
+}
+
+class AttackDetector:
     """
-    Get Bot Fight Mode status for Free plan.
-    WARNING: BFM may block legitimate API or mobile app traffic. Disable if issues occur.
-    See: https://developers.cloudflare.com/bots/get-started/free/
+    Sliding-window attack detector with hysteresis for one zone.
+    feed() takes one per-minute sample ({"requests", "threats", "cachedRequests"})
+    and returns "escalate", "deescalate" or None. It does no I/O, so the same
+    rules can be replayed against recorded traces with replay_trace().
     """
-    url = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/bot_management"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
-    }
-    async with aiohttp.ClientSession() as session:
+
+    def __init__(self, rules=None, window=ATTACK_WINDOW_MINUTES, calm_factor=ATTACK_CALM_FACTOR,
+                 min_rate=ATTACK_MIN_RATE, escalate_after=ATTACK_ESCALATE_AFTER, deescalate_after=ATTACK_DEESCALATE_AFTER):
+        self.rules = {name: threshold for name, threshold in (rules or ATTACK_RULES).items() if threshold}
+        self.samples = deque(maxlen=window)
+        self.totals = [0, 0, 0]
+        self.calm_factor = calm_factor
+        self.min_rate = min_rate
+        self.escalate_after = escalate_after
+        self.deescalate_after = deescalate_after
+        self.under_attack = False
+        self.hot = 0
+        self.calm = 0
+        self.triggered = []
+        self.reason = ""
+
+    def metrics(self):
+        requests, threats, cached = self.totals
+        rate = requests / len(self.samples) if self.samples else 0
+        noisy = rate < self.min_rate or not requests
+        return {
+            "request_rate": rate,
+            "threat_ratio": 0 if noisy else threats / requests,
+            "origin_ratio": 0 if noisy else (requests - cached) / requests,
+        }
+
+    def feed(self, sample):
+        values = (sample.get("requests") or 0, sample.get("threats") or 0, sample.get("cachedRequests") or 0)
+        if len(self.samples) == self.samples.maxlen:
+            self.totals = [total - old for total, old in zip(self.totals, self.samples[0])]
+        self.samples.append(values)
+        self.totals = [total + new for total, new in zip(self.totals, values)]
+
+        metrics = self.metrics()
+        triggered = [name for name, threshold in self.rules.items() if metrics[name] >= threshold]
+        if not self.under_attack:
+            self.hot = self.hot + 1 if triggered else 0
+            if self.hot >= self.escalate_after:
+                self.under_attack, self.hot = True, 0
+                self.triggered = triggered
+                self.reason = ", ".join(f"{name}={metrics[name]:.2f}" for name in triggered)
+                return "escalate"
+        else:
+            # Hysteresis: the rules that fired must drop well below their thresholds
+            calm = all(metrics[name] < self.rules[name] * self.calm_factor for name in self.triggered)
+            self.calm = self.calm + 1 if calm else 0
+            if self.calm >= self.deescalate_after:
+                self.under_attack, self.calm = False, 0
+                self.reason = ", ".join(f"{name}={metrics[name]:.2f}" for name in self.triggered)
+                return "deescalate"
+        return None
+
+def replay_trace(samples, **detector_options):
+    """Run recorded per-minute samples through a fresh detector; returns [(datetime or index, decision, reason)]."""
+    detector = AttackDetector(**detector_options)
+    decisions = []
+    for index, sample in enumerate(samples):
+        decision = detector.feed(sample)
+        if decision:
+            decisions.append((sample.get("datetime", index), decision, detector.reason))
+    return decisions
+
+def pack_messages(blocks, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Join text blocks with blank lines into as few messages as fit Telegram's length limit."""
+    messages = []
+    for block in blocks:
+        if messages and len(messages[-1]) + 2 + len(block) <= limit:
+            messages[-1] += "\n\n" + block
+        else:
+            messages.append(block[:limit])
+    return messages
+
+async def notify_admins(text):
+    async def send(user_id):
         try:
-            async with session.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    logging.error(f"Bot Fight Mode status API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}"
-                data = await resp.json()
-                if not data.get("success"):
-                    logging.error(f"Bot Fight Mode status API failed: {data.get('errors')}")
-                    return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
-                state = data.get("result", {}).get("fight_mode", False)
-                return "on" if state is True else "off"
-        except aiohttp.ClientError as e:
-            logging.error(f"Bot Fight Mode status connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
+            await bot.send_message(user_id, text, parse_mode="HTML")
+        except TelegramAPIError as e:
+            logging.error(f"Failed to notify admin {user_id}: {str(e)}")
+
+    await asyncio.gather(*(send(user_id) for user_id in ALLOWED_USERS))
 
-async def set_bot_fight_mode(state):
+class AttackEngine:
     """
-    Set Bot Fight Mode on or off for Free plan.
-    WARNING: BFM may block legitimate API or mobile app traffic. Disable if issues occur.
-    See: https://developers.cloudflare.com/bots/get-started/free/
+    Polls per-minute traffic for every zone from the same GraphQL API as the
+    analytics, feeds it to an AttackDetector per zone and applies or reverts
+    mitigation (Under Attack + Bot Fight Mode) on its decisions.
     """
-    url = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/bot_management"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {"super_fight_mode": state == "on"}
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.put(url, headers=headers, json=payload) as resp:
-                if resp.status != 200:
-                    logging.error(f"Bot Fight Mode API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}", f"Ошибка API: {resp.status}"
-                data = await resp.json()
-                if not data.get("success"):
-                    logging.error(f"Set Bot Fight Mode API failed: {data.get('errors')}")
-                    return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}", f"Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
-                state_str = "включен" if state == "on" else "выключен"
-                return f"✅ Bot Fight Mode {state_str}: <b>{state}</b>", f"Bot Fight Mode {state_str}: {state}"
-        except aiohttp.ClientError as e:
-            logging.error(f"Bot Fight Mode connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
-
-async def get_browser_integrity_check_status():
-    url = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/settings/browser_check"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
-    }
-    async with aiohttp.ClientSession() as session:
+
+    def __init__(self, interval=ATTACK_POLL_INTERVAL):
+        self.interval = interval
+        self.detectors = {}
+        self.last_seen = {}
+        self.previous = {}
+        self.task = None
+
+    async def poll(self):
+        zone_ids = list(CLOUDFLARE_ZONES.values())
+        # Minutes younger than the ingestion lag are still being counted; reading
+        # them now would feed a partial sample that is never re-read
+        until = datetime.datetime.utcnow().replace(second=0, microsecond=0) - datetime.timedelta(minutes=ATTACK_INGEST_LAG_MINUTES)
+        since = until - datetime.timedelta(minutes=ATTACK_WINDOW_MINUTES)
+        query = """
+        query {
+            viewer {
+                zones(filter: {zoneTag_in: [%s]}) {
+                    zoneTag
+                    httpRequests1mGroups(
+                        limit: %d
+                        filter: { datetime_geq: "%s", datetime_lt: "%s" }
+                        orderBy: [datetime_ASC]
+                    ) {
+                        sum {
+                            requests
+                            threats
+                            cachedRequests
+                        }
+                        dimensions {
+                            datetime
+                        }
+                    }
+                }
+            }
+        }
+        """ % (", ".join(f'"{zone_id}"' for zone_id in zone_ids), ATTACK_WINDOW_MINUTES, since.isoformat() + "Z", until.isoformat() + "Z")
         try:
-            async with session.get(url, headers=headers) as resp:
-                if resp.status != 200:
-                    logging.error(f"Browser Integrity Check status API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}"
-                data = await resp.json()
-                if not data.get("success"):
-                    logging.error(f"Browser Integrity Check status API failed: {data.get('errors')}")
-                    return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
-                state = data.get("result", {}).get("value", "unknown")
-                return state
+            status, data = await cf.request("POST", "/graphql", json={"query": query})
         except aiohttp.ClientError as e:
-            logging.error(f"Browser Integrity Check status connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}"
-
-async def set_browser_integrity_check(state):
-    url = f"https://api.cloudflare.com/client/v4/zones/{CLOUDFLARE_ZONE_ID}/settings/browser_check"
-    headers = {
-        "X-Auth-Email": CLOUDFLARE_EMAIL,
-        "X-Auth-Key": CLOUDFLARE_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {"value": state}
-    async with aiohttp.ClientSession() as session:
+            logging.error(f"Attack detection connection error: {str(e)}")
+            return
+        if status != 200 or data.get("errors"):
+            logging.error(f"Attack detection API error: {status} - {data}")
+            return
+        for zone in data.get("data", {}).get("viewer", {}).get("zones", []):
+            zone_id = zone.get("zoneTag")
+            detector = self.detectors.setdefault(zone_id, AttackDetector())
+            for group in zone.get("httpRequests1mGroups") or []:
+                minute = group["dimensions"]["datetime"]
+                if minute <= self.last_seen.get(zone_id, ""):
+                    continue
+                self.last_seen[zone_id] = minute
+                detector.feed(group["sum"])
+
+        # Reconcile every zone, not only the ones with a fresh decision: a
+        # mitigation or revert that failed last time is retried on this poll
+        changes = []
+        for zone_id, detector in self.detectors.items():
+            if detector.under_attack and zone_id not in self.previous:
+                changes.append(self.escalate(zone_id, detector.reason))
+            elif not detector.under_attack and zone_id in self.previous:
+                changes.append(self.deescalate(zone_id, detector.reason))
+        reports = await asyncio.gather(*changes)
+        for text in pack_messages(reports):
+            await notify_admins(text)
+
+    async def escalate(self, zone_id, reason):
+        """Apply mitigation; the zone counts as mitigated only once Under Attack is set."""
+        status = await get_zone_status(zone_id, ("level", "bfm"))
+        (level_result, _), (bfm_result, _) = await asyncio.gather(
+            set_security_level("under_attack", zone_id),
+            set_bot_fight_mode("on", zone_id)
+        )
+        name = html.escape(ZONE_NAMES.get(zone_id, zone_id))
+        if is_error_status(level_result):
+            logging.error(f"Attack detected on zone {zone_id} ({reason}), mitigation failed, retrying on next poll")
+            return f"🚨 Атака на зону <b>{name}</b>, включить защиту не удалось, повтор при следующей проверке\n{level_result}"
+        self.previous[zone_id] = status
+        logging.warning(f"Attack detected on zone {zone_id} ({reason}), mitigation applied")
+        return f"🚨 Обнаружена атака на зону <b>{name}</b>\nСработали правила: {reason}\n{level_result}\n{bfm_result}"
+
+    async def deescalate(self, zone_id, reason):
+        """Revert mitigation to the settings saved by escalate(); kept for a retry if the revert fails."""
+        previous = self.previous[zone_id]
+        level = previous.get("level")
+        if level is None or is_error_status(level) or level == "under_attack":
+            level = "medium"
+        results = [await set_security_level(level, zone_id)]
+        if previous.get("bfm") == "off":
+            results.append(await set_bot_fight_mode("off", zone_id))
+        name = html.escape(ZONE_NAMES.get(zone_id, zone_id))
+        if is_error_status(results[0][0]):
+            logging.error(f"Attack on zone {zone_id} subsided ({reason}), revert failed, retrying on next poll")
+            return f"⚠️ Атака на зону <b>{name}</b> завершилась, вернуть настройки не удалось, повтор при следующей проверке\n{results[0][0]}"
+        del self.previous[zone_id]
+        logging.warning(f"Attack on zone {zone_id} subsided ({reason}), mitigation reverted")
+        return f"✅ Атака на зону <b>{name}</b> завершилась\nПоказатели: {reason}\n" + "\n".join(result for result, _ in results)
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logging.error(f"Attack detection error: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+attack_engine = AttackEngine()
+
+# ===== Access and Coalescing Middleware =====
+class AccessMiddleware(BaseMiddleware):
+    """Rejects updates from users outside ALLOWED_USERS before any handler runs."""
+
+    def __init__(self, allowed_users):
+        self.allowed_users = allowed_users
+
+    async def __call__(self, handler, event, data):
+        if event.from_user.id in self.allowed_users:
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            await event.answer("🚫 Нет доступа.", show_alert=True)
+        else:
+            await event.answer("🚫 У вас нет доступа к этому боту.")
+
+class ActionCoalescingMiddleware(BaseMiddleware):
+    """
+    Runs one handler per (user, button text or callback data) at a time:
+    repeated presses wait for the pending one instead of starting their own
+    Cloudflare calls and edits. Actions that reach Cloudflare also share a
+    global semaphore.
+    """
+
+    def __init__(self, cloudflare_concurrency=CLOUDFLARE_ACTION_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(cloudflare_concurrency)
+        self.inflight = {}  # (user_id, action key) -> Event set when the handler finishes
+
+    async def __call__(self, handler, event, data):
+        is_callback = isinstance(event, CallbackQuery)
+        if is_callback:
+            key = (event.from_user.id, event.data)
+        elif event.document is not None:
+            key = (event.from_user.id, event.caption, event.document.file_unique_id)
+        else:
+            key = (event.from_user.id, event.text)
+        pending = self.inflight.get(key)
+        if pending is not None:
+            metrics.inc("bot_updates_coalesced_total", handler="callbacks" if is_callback else "handle_buttons")
+            await pending.wait()
+            if is_callback:
+                # The first press already answered with the result; just stop the spinner
+                try:
+                    await event.answer()
+                except TelegramAPIError as e:
+                    logging.debug(f"Coalesced callback answer failed: {str(e)}")
+            return None
+        self.inflight[key] = done = asyncio.Event()
         try:
-            async with session.patch(url, headers=headers, json=payload) as resp:
-                if resp.status != 200:
-                    logging.error(f"Browser Integrity Check API error: {resp.status} - {await resp.text()}")
-                    return f"❌ Ошибка API: {resp.status} - {await resp.text()}", f"Ошибка API: {resp.status}"
-                data = await resp.json()
-                if not data.get("success"):
-                    logging.error(f"Set Browser Integrity Check API failed: {data.get('errors')}")
-                    return f"❌ Ошибка API: {data.get('errors', 'Неизвестная ошибка')}", f"Ошибка API: {data.get('errors', 'Неизвестная ошибка')}"
-                state_str = "включена" if state == "on" else "выключена"
-                return f"✅ Browser Integrity Check {state_str}: <b>{state}</b>", f"Browser Integrity Check {state_str}: {state}"
-        except aiohttp.ClientError as e:
-            logging.error(f"Browser Integrity Check connection error: {str(e)}")
-            return f"❌ Ошибка соединения с Cloudflare: {str(e)}", f"Ошибка соединения с Cloudflare: {str(e)}"
+            if data.get("action") in CLOUDFLARE_ACTIONS:
+                async with self.semaphore:
+                    return await handler(event, data)
+            return await handler(event, data)
+        finally:
+            del self.inflight[key]
+            done.set()
+
+access_middleware = AccessMiddleware(ALLOWED_USERS)
+action_coalescer = ActionCoalescingMiddleware()
+for observer in (dp.message, dp.callback_query):
+    observer.middleware(access_middleware)
+    observer.middleware(action_coalescer)
 
 # ===== Handlers =====
 @dp.message(Command("start"))
 async def start(message: types.Message):
-    if message.from_user.id not in ALLOWED_USERS:
-        await message.answer("🚫 У вас нет доступа к этому боту.")
-        return
     try:
         await message.answer("Васап ма бой выбери кнопку:", parse_mode="HTML", reply_markup=main_kb)
     except TelegramNetworkError as e:
         logging.error(f"Telegram start timeout: {str(e)}")
 
-@dp.message()
-async def handle_buttons(message: types.Message):
-    if message.from_user.id not in ALLOWED_USERS:
-        await message.answer("🚫 У вас нет доступа к этому боту.")
-        return
+@dp.message(Command("stats"))
+async def stats(message: types.Message):
+    cache_stats = settings_cache.stats
     try:
-        if message.text == "🛡️ Включить защиту":
-            result, _ = await set_security_level("under_attack")
-            await message.answer(result, parse_mode="HTML")
-        elif message.text == "⚪ Выключить защиту":
-            result, _ = await set_security_level("essentially_off")
-            await message.answer(result, parse_mode="HTML")
-        elif message.text == "👁️ Показать текущий уровень":
-            level = await get_security_level()
-            await message.answer(level, parse_mode="HTML")
-        elif message.text == "📊 Показать аналитику":
-            analytics, _ = await get_security_analytics()
-            await message.answer(analytics, parse_mode="HTML", reply_markup=analytics_kb)
-        elif message.text == "🔒 Anti-DDoS":
-            bfm_status = await get_bot_fight_mode_status()
-            bic_status = await get_browser_integrity_check_status()
-            status_message = (
-                f"🔒 Статус Anti-DDoS:\n"
-                f"Bot Fight Mode: <b>{bfm_status}</b>\n"
-                f"Browser Integrity Check: <b>{bic_status}</b>"
+        await message.answer(
+            f"📈 Кэш настроек:\n"
+            f"Попадания: <b>{cache_stats['hits']}</b>\n"
+            f"Промахи: <b>{cache_stats['misses']}</b>\n"
+            f"Устаревшие: <b>{cache_stats['stale']}</b>\n"
+            f"Из снимка: <b>{cache_stats['warm']}</b>",
+            parse_mode="HTML"
+        )
+    except TelegramNetworkError as e:
+        logging.error(f"Telegram stats timeout: {str(e)}")
+
+@dp.message(Command("audit"))
+async def audit(message: types.Message):
+    rows = await state_store.recent_actions()
+    if not rows:
+        text = "📜 Журнал изменений пуст."
+    else:
+        lines = ["📜 Последние изменения (UTC):"]
+        for ts, user_id, zone_id, setting, value, latency_ms, outcome in rows:
+            result = "✅" if outcome == "ok" else f"❌ {html.escape(outcome)}"
+            lines.append(
+                f"{time.strftime('%d.%m %H:%M:%S', time.gmtime(ts))} · {user_id or 'авто'} · "
+                f"{html.escape(ZONE_NAMES.get(zone_id, zone_id))} · {setting}=<b>{html.escape(value)}</b> · "
+                f"{latency_ms:.0f} мс {result}"
             )
-            await message.answer(status_message, reply_markup=anti_ddos_kb, parse_mode="HTML")
+        text = "\n".join(lines)
+    try:
+        await message.answer(text, parse_mode="HTML")
+    except TelegramNetworkError as e:
+        logging.error(f"Telegram audit timeout: {str(e)}")
+
+@dp.message(Command("block", "challenge", "unblock"))
+async def access_rules(message: types.Message, command: CommandObject):
+    if message.document is None and not command.args:
+        await message.answer(
+            "Использование: <code>/block 1.2.3.4 10.0.0.0/20 AS13335 CN</code>\n"
+            "Или отправьте файл со списком (по одной или несколько записей в строке) с подписью /block, /challenge или /unblock.",
+            parse_mode="HTML"
+        )
+        return
+    zone_id = get_user_zone(message.from_user.id)
+    entries = AccessList()
+    job = AccessRuleJob(zone_id, command.command, message.from_user.id)
+    status_message = await message.answer(job.render(entries), parse_mode="HTML")
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(ACCESS_RULES_PROGRESS_INTERVAL)
+            try:
+                await edit_if_changed(status_message, job.render(entries), None)
+            except TelegramAPIError as e:
+                logging.debug(f"Access rules progress edit failed: {str(e)}")
+
+    progress = asyncio.create_task(report_progress())
+    try:
+        if command.args:
+            entries.add_line(command.args)
+        if message.document is not None:
+            try:
+                async for line in document_lines(message.document):
+                    entries.add_line(line)
+            except (TelegramAPIError, aiohttp.ClientError) as e:
+                logging.error(f"Access list download error: {str(e)}")
+                job.errors.append(f"❌ Не удалось загрузить файл: {str(e)}")
+        if not job.errors:
+            async with access_rule_jobs:
+                await job.run(entries.targets())
+    finally:
+        # Stop the progress edits before the final one so it cannot be coalesced away
+        progress.cancel()
+        try:
+            await progress
+        except asyncio.CancelledError:
+            pass
+        job.finished = time.monotonic()
+    outcome = job.errors[0] if job.errors else "ok"
+    state_store.record_action(message.from_user.id, zone_id, "access_rules", f"{command.command}: {entries.entries}", job.finished - job.started, outcome)
+    await edit_if_changed(status_message, job.render(entries), None)
+
+@dp.message(F.document)
+async def document_without_command(message: types.Message):
+    await message.answer("📄 Подпишите файл командой /block, /challenge или /unblock.")
+
+# ===== Actions =====
+# Declarative action registry: button text / callback data -> handler coroutine.
+# Every handler is called as handler(event, zone_id, arg); arg is the part after
+# "prefix:" for prefixed callback data and None otherwise.
+# Handlers registered with local=True never call Cloudflare and skip the
+# global Cloudflare semaphore.
+BUTTON_ACTIONS = {}
+CALLBACK_ACTIONS = {}
+CALLBACK_PREFIXES = {}
+CLOUDFLARE_ACTIONS = set()
+
+def button_action(*texts, local=False):
+    def register(handler):
+        for text in texts:
+            BUTTON_ACTIONS[text] = handler
+        if not local:
+            CLOUDFLARE_ACTIONS.add(handler)
+        return handler
+    return register
+
+def callback_action(*datas, prefix=None, local=False):
+    def register(handler):
+        for data in datas:
+            CALLBACK_ACTIONS[data] = handler
+        if not local:
+            CLOUDFLARE_ACTIONS.add(handler)
+        if prefix:
+            CALLBACK_PREFIXES[prefix] = handler
+        return handler
+    return register
+
+def resolve_button(message: types.Message):
+    action = BUTTON_ACTIONS.get(message.text)
+    return {"action": action, "arg": None} if action else False
+
+def resolve_callback(query: CallbackQuery):
+    action = CALLBACK_ACTIONS.get(query.data)
+    if action:
+        return {"action": action, "arg": None}
+    prefix, _, arg = (query.data or "").partition(":")
+    action = CALLBACK_PREFIXES.get(prefix)
+    return {"action": action, "arg": arg} if action and arg else False
+
+def markup_signature(markup):
+    if markup is None:
+        return None
+    return tuple(tuple((button.text, button.callback_data) for button in row) for row in markup.inline_keyboard)
+
+class EditDebouncer:
+    """
+    Serializes edits of each message. While an edit is being sent (and for
+    `delay` seconds after it when more are queued) newer edits only replace
+    the pending content, so bursts collapse into the latest state.
+    """
+
+    def __init__(self, delay=EDIT_DEBOUNCE):
+        self.delay = delay
+        self.latest = {}  # (chat_id, message_id) -> newest (text, reply_markup)
+
+    async def edit(self, message, text, reply_markup):
+        """Returns False when the message already shows this content and nothing was sent."""
+        key = (message.chat.id, message.message_id)
+        if key in self.latest:
+            metrics.inc("telegram_edits_coalesced_total")
+            self.latest[key] = (text, reply_markup)
+            return True
+        self.latest[key] = entry = (text, reply_markup)
+        shown = (message.html_text, markup_signature(message.reply_markup))
+        edited = False
+        try:
+            while True:
+                text, reply_markup = entry
+                wanted = (text, markup_signature(reply_markup))
+                if wanted != shown:
+                    await message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
+                    shown = wanted
+                    edited = True
+                if self.latest[key] is entry:
+                    return edited
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                entry = self.latest[key]
+        finally:
+            del self.latest[key]
+
+edit_debouncer = EditDebouncer()
+
+async def edit_if_changed(message, text, reply_markup):
+    """Edit the message only when text or keyboard differ; returns False when the edit was skipped."""
+    return await edit_debouncer.edit(message, text, reply_markup)
+
+@functools.lru_cache(maxsize=64)
+def zones_kb_for(current_zone_id):
+    # Buttons carry the zone id (32 hex chars): names may exceed Telegram's 64-byte callback_data limit
+    rows = [
+        [InlineKeyboardButton(text=f"{'✅ ' if zone_id == current_zone_id else ''}{name}", callback_data=f"zone:{zone_id}")]
+        for name, zone_id in CLOUDFLARE_ZONES.items()
+    ]
+    rows.append([InlineKeyboardButton(text="🚨 Under Attack на всех зонах", callback_data="bulk:under_attack")])
+    rows.append([InlineKeyboardButton(text="⚪ Выключить защиту на всех зонах", callback_data="bulk:essentially_off")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def zones_message(zone_id):
+    return f"🌐 Текущая зона: <b>{html.escape(ZONE_NAMES.get(zone_id, zone_id))}</b>\nВыберите зону:"
+
+@button_action("🛡️ Включить защиту", "⚪ Выключить защиту")
+async def toggle_protection(message, zone_id, arg):
+    level = "under_attack" if message.text == "🛡️ Включить защиту" else "essentially_off"
+    result, _ = await set_security_level(level, zone_id, user_id=message.from_user.id)
+    await message.answer(result, parse_mode="HTML")
+
+@button_action("👁️ Показать текущий уровень")
+async def show_security_level(message, zone_id, arg):
+    await message.answer(await get_security_level(zone_id), parse_mode="HTML")
+
+@button_action("📊 Показать аналитику")
+async def show_analytics(message, zone_id, arg):
+    analytics, _ = await get_security_analytics(zone_id)
+    await message.answer(analytics, parse_mode="HTML", reply_markup=analytics_kb)
+
+@button_action("🔒 Anti-DDoS")
+async def show_anti_ddos(message, zone_id, arg):
+    status_message = await get_anti_ddos_status_message(zone_id=zone_id)
+    await message.answer(status_message, reply_markup=anti_ddos_kb, parse_mode="HTML")
+
+@button_action("🌐 Зоны", local=True)
+async def show_zones(message, zone_id, arg):
+    await message.answer(zones_message(zone_id), reply_markup=zones_kb_for(zone_id), parse_mode="HTML")
+
+@callback_action("essentially_off", "low", "medium", "high", "under_attack")
+async def choose_security_level(query, zone_id, arg):
+    result, alert = await set_security_level(query.data, zone_id, user_id=query.from_user.id)
+    await query.answer(alert, show_alert=True)
+    await edit_if_changed(query.message, result, level_kb)
+
+@callback_action("select_security_level", local=True)
+async def select_security_level(query, zone_id, arg):
+    await edit_if_changed(query.message, "Выберите уровень защиты:", level_kb)
+    await query.answer()
+
+@callback_action("refresh_analytics")
+async def refresh_analytics(query, zone_id, arg):
+    analytics, _ = await get_security_analytics(zone_id)
+    if await edit_if_changed(query.message, analytics, analytics_kb):
+        await query.answer()
+    else:
+        await query.answer("📊 Данные аналитики не изменились.")
+
+@callback_action("bfm_on", "bfm_off", "bic_on", "bic_off")
+async def toggle_anti_ddos(query, zone_id, arg):
+    setting, _, state = query.data.partition("_")
+    setter = set_bot_fight_mode if setting == "bfm" else set_browser_integrity_check
+    result, alert = await setter(state, zone_id, user_id=query.from_user.id)
+    # The setter has already written the new value to the settings cache,
+    # so this render is served locally while the alert is being sent
+    answered = asyncio.ensure_future(query.answer(alert, show_alert=True))
+    status_message = await get_anti_ddos_status_message(zone_id=zone_id)
+    await answered
+    await edit_if_changed(query.message, status_message, anti_ddos_kb)
+
+@callback_action(prefix="zone", local=True)
+async def select_zone(query, zone_id, arg):
+    if arg in ZONE_NAMES:
+        selected_zones[query.from_user.id] = arg
+        zone_id = arg
+    await query.answer(f"Текущая зона: {ZONE_NAMES.get(zone_id, zone_id)}")
+    await edit_if_changed(query.message, zones_message(zone_id), zones_kb_for(zone_id))
+
+@callback_action(prefix="bulk")
+async def bulk_security_level(query, zone_id, arg):
+    result, alert = await apply_security_level_to_all_zones(arg, user_id=query.from_user.id)
+    await query.answer(alert, show_alert=True)
+    await edit_if_changed(query.message, result, zones_kb_for(zone_id))
+
+actions_router = Router(name="actions")
+
+@actions_router.message(resolve_button)
+async def handle_buttons(message: types.Message, action, arg):
+    try:
+        await action(message, get_user_zone(message.from_user.id), arg)
     except TelegramNetworkError as e:
         logging.error(f"Telegram button timeout: {str(e)}")
         await message.answer(f"⚠️ Ошибка Telegram: {str(e)}", parse_mode="HTML")
 
-@dp.callback_query()
-async def callbacks(query: CallbackQuery):
-    if query.from_user.id not in ALLOWED_USERS:
-        await query.answer("🚫 Нет доступа.", show_alert=True)
-        return
+@actions_router.callback_query(resolve_callback)
+async def callbacks(query: CallbackQuery, action, arg):
     try:
-        if query.data in ["essentially_off", "low", "medium", "high", "under_attack"]:
-            result, alert = await set_security_level(query.data)
-            await query.answer(alert, show_alert=True)
-            await query.message.edit_text(result, reply_markup=level_kb, parse_mode="HTML")
-        elif query.data == "select_security_level":
-            await query.message.edit_text("Выберите уровень защиты:", reply_markup=level_kb, parse_mode="HTML")
-        elif query.data == "refresh_analytics":
-            analytics, _ = await get_security_analytics()
-            await query.message.edit_text(analytics, reply_markup=analytics_kb, parse_mode="HTML")
-        elif query.data in ["bfm_on", "bfm_off"]:
-            state = "on" if query.data == "bfm_on" else "off"
-            result, alert = await set_bot_fight_mode(state)
-            await query.answer(alert, show_alert=True)
-            bfm_status = await get_bot_fight_mode_status()
-            bic_status = await get_browser_integrity_check_status()
-            status_message = (
-                f"🔒 Статус Anti-DDoS:\n"
-                f"Bot Fight Mode: <b>{bfm_status}</b>\n"
-                f"Browser Integrity Check: <b>{bic_status}</b>"
-            )
-            await query.message.edit_text(status_message, reply_markup=anti_ddos_kb, parse_mode="HTML")
-        elif query.data in ["bic_on", "bic_off"]:
-            state = "on" if query.data == "bic_on" else "off"
-            result, alert = await set_browser_integrity_check(state)
-            await query.answer(alert, show_alert=True)
-            bfm_status = await get_bot_fight_mode_status()
-            bic_status = await get_browser_integrity_check_status()
-            status_message = (
-                f"🔒 Статус Anti-DDoS:\n"
-                f"Bot Fight Mode: <b>{bfm_status}</b>\n"
-                f"Browser Integrity Check: <b>{bic_status}</b>"
-            )
-            await query.message.edit_text(status_message, reply_markup=anti_ddos_kb, parse_mode="HTML")
+        await action(query, get_user_zone(query.from_user.id), arg)
     except TelegramBadRequest as e:
         if "message is not modified" in str(e):
-            if query.data == "refresh_analytics":
-                await query.message.edit_text("📊 Данные аналитики не изменились.", reply_markup=analytics_kb, parse_mode="HTML")
-            elif query.data in ["bfm_on", "bfm_off", "bic_on", "bic_off"]:
-                bfm_status = await get_bot_fight_mode_status()
-                bic_status = await get_browser_integrity_check_status()
-                status_message = (
-                    f"🔒 Статус Anti-DDoS не изменился:\n"
-                    f"Bot Fight Mode: <b>{bfm_status}</b>\n"
-                    f"Browser Integrity Check: <b>{bic_status}</b>"
-                )
-                await query.message.edit_text(status_message, reply_markup=anti_ddos_kb, parse_mode="HTML")
-            else:
-                await query.message.edit_text("⚠️ Данные не изменились.", reply_markup=query.message.reply_markup, parse_mode="HTML")
+            logging.debug(f"Callback {query.data} produced an identical message")
         else:
             logging.error(f"Telegram bad request: {str(e)}")
             await query.answer(f"⚠️ Ошибка Telegram: {str(e)}", show_alert=True)
@@ -390,6 +2163,71 @@ async def callbacks(query: CallbackQuery):
         logging.error(f"Callback error: {str(e)}")
         await query.answer(f"⚠️ Ошибка: {str(e)}", show_alert=True)
 
+dp.include_router(actions_router)
+
+# ===== Lifecycle =====
+async def warm_start():
+    """Seed caches from the state snapshot, then refresh every zone's settings in the background."""
+    settings, analytics = await state_store.open()
+    for zone_id, setting, value in settings:
+        settings_cache.preload((zone_id, setting), value)
+    for zone_id, hour, sums, updated_at in analytics:
+        store = analytics_poller.stores.setdefault(zone_id, AnalyticsStore())
+        store.merge(hour, json.loads(sums))
+        store.updated_at = max(store.updated_at or 0, updated_at)
+    for store in analytics_poller.stores.values():
+        store.advance(int(time.time()) // 3600)
+    if settings or analytics:
+        logging.info(f"Loaded state snapshot: {len(settings)} settings, {len(analytics)} analytics buckets")
+    fetchers = {
+        "security_level": fetch_security_level_status,
+        "bot_fight_mode": fetch_bot_fight_mode_status,
+        "browser_check": fetch_browser_integrity_check_status,
+    }
+    for zone_id in CLOUDFLARE_ZONES.values():
+        for setting, fetcher in fetchers.items():
+            # Background priority: a restart must not queue these ahead of operators' actions
+            settings_cache.refresh((zone_id, setting), functools.partial(fetcher, zone_id, background=True))
+    state_store.start()
+
+@dp.startup()
+async def on_startup():
+    await cf.start()
+    await warm_start()
+    await metrics_server.start()
+    analytics_poller.start()
+    if AUTO_MITIGATION:
+        attack_engine.start()
+
+@dp.shutdown()
+async def on_shutdown():
+    await update_limiter.drain(SHUTDOWN_TIMEOUT)
+    await attack_engine.stop()
+    await analytics_poller.stop()
+    await cf.close()
+    await state_store.stop()
+    await metrics_server.stop()
+
 # ===== Run Bot =====
+async def set_webhook(app):
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+
+def create_webhook_app():
+    app = web.Application()
+    # Order matters on shutdown: the dispatcher drains updates and closes the
+    # Cloudflare client before the request handler closes the bot session.
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.on_startup.append(set_webhook)
+    return app
+
+async def run_polling():
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        web.run_app(create_webhook_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        asyncio.run(run_polling())
\ No newline at end of file
@@ -0,0 +1,10 @@
+"""Test setup: main.py reads its configuration at import time."""
+import os
+import sys
+
+# main.py validates the token at import time, so give it a well-formed fake one.
+os.environ.setdefault("BOT_TOKEN", "123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+os.environ.setdefault("CLOUDFLARE_ZONE_ID", "test-zone")
+# Keep test runs from touching the bot's state database.
+os.environ.setdefault("STATE_DB_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
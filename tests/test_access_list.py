@@ -0,0 +1,70 @@
+import ipaddress
+
+import main
+
+
+def parse(*lines):
+    entries = main.AccessList()
+    for line in lines:
+        entries.add_line(line)
+    return entries, list(entries.targets())
+
+
+def test_addresses_ranges_asns_and_countries():
+    entries, targets = parse("1.2.3.4, 8.8.8.0/24; 2001:db8::1 AS13335 asn64512 CN")
+    assert targets == [
+        ("ip", "1.2.3.4"),
+        ("ip_range", "8.8.8.0/24"),
+        ("ip6", "2001:db8::1"),
+        ("asn", "AS13335"),
+        ("asn", "AS64512"),
+        ("country", "CN"),
+    ]
+    assert entries.entries == 6
+    assert entries.invalid == 0
+
+
+def test_comments_blank_lines_and_duplicates():
+    entries, targets = parse("# header", "", "1.2.3.4 # seen twice", "1.2.3.4")
+    assert targets == [("ip", "1.2.3.4")]
+    assert entries.entries == 2
+
+
+def test_overlapping_networks_are_collapsed():
+    _, targets = parse("10.0.0.0/24 10.0.0.7 10.0.1.0/24")
+    assert targets == [("ip_range", "10.0.0.0/24"), ("ip_range", "10.0.1.0/24")]
+
+
+def test_unaccepted_prefixes_are_split():
+    _, targets = parse("10.0.0.0/23 192.168.0.0/30 2001:db8::/47")
+    assert targets[:2] == [("ip_range", "10.0.0.0/24"), ("ip_range", "10.0.1.0/24")]
+    assert targets[2:6] == [("ip", f"192.168.0.{i}") for i in range(4)]
+    assert targets[6:] == [("ip_range", "2001:db8::/48"), ("ip_range", "2001:db8:1::/48")]
+
+
+def test_too_wide_network_does_not_drop_other_entries():
+    entries, targets = parse("1.2.3.4 8.8.8.0/24 2001:db8::1 ::/0 0.0.0.0/0")
+    assert targets == [("ip", "1.2.3.4"), ("ip_range", "8.8.8.0/24"), ("ip6", "2001:db8::1")]
+    assert entries.invalid == 2
+    assert entries.samples == ["::/0: слишком широкая сеть", "0.0.0.0/0: слишком широкая сеть"]
+
+
+def test_valid_networks_collapsing_into_a_too_wide_one_are_kept():
+    entries, targets = parse("10.0.0.0/8 11.0.0.0/8")
+    assert entries.invalid == 0
+    assert len(targets) == 512
+    covered = [ipaddress.ip_network(value) for _, value in targets]
+    assert list(ipaddress.collapse_addresses(covered)) == [ipaddress.ip_network("10.0.0.0/7")]
+
+
+def test_junk_is_rejected():
+    entries, targets = parse("not-an-ip 1.2.3.4")
+    assert targets == [("ip", "1.2.3.4")]
+    assert entries.invalid == 1
+    assert entries.samples == ["not-an-ip"]
+
+
+def test_only_uppercase_iso_codes_are_countries():
+    entries, targets = parse("1.2.3.4 do not block", "ip,country", "as T1 DO XX")
+    assert targets == [("ip", "1.2.3.4"), ("country", "DO"), ("country", "T1")]
+    assert entries.invalid == 7
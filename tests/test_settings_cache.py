@@ -0,0 +1,65 @@
+import asyncio
+
+import main
+
+
+def test_write_during_load_is_not_overwritten():
+    async def scenario():
+        cache = main.SettingsCache({})
+        key = ("zone", "security_level")
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_fetch():
+            started.set()
+            await release.wait()
+            return "medium"
+
+        read = asyncio.create_task(cache.get_or_fetch(key, slow_fetch))
+        await started.wait()
+        cache.set(key, "under_attack")
+        release.set()
+        assert await read == "under_attack"
+        assert await cache.get_or_fetch(key, slow_fetch) == "under_attack"
+        assert not cache.inflight
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_during_load_starts_a_fresh_one():
+    async def scenario():
+        cache = main.SettingsCache({})
+        key = ("zone", "bot_fight_mode")
+        values = iter(["off", "on"])
+        release = asyncio.Event()
+
+        async def fetch():
+            value = next(values)
+            if value == "off":
+                await release.wait()
+            return value
+
+        stale = asyncio.create_task(cache.get_or_fetch(key, fetch))
+        await asyncio.sleep(0)
+        cache.invalidate(key)
+        # Before generations existed this joined the stale load and hung
+        assert await asyncio.wait_for(cache.get_or_fetch(key, fetch), 1) == "on"
+        release.set()
+        await stale
+        assert cache.entries[key][0] == "on"
+
+    asyncio.run(scenario())
+
+
+def test_error_results_are_not_cached():
+    async def scenario():
+        cache = main.SettingsCache({})
+        key = ("zone", "browser_check")
+        results = iter(["❌ Ошибка API: 503", "on"])
+
+        async def fetch():
+            return next(results)
+
+        assert (await cache.get_or_fetch(key, fetch)).startswith("❌")
+        assert await cache.get_or_fetch(key, fetch) == "on"
+
+    asyncio.run(scenario())
@@ -0,0 +1,16 @@
+import pytest
+
+import main
+
+
+def test_zone_names_are_escaped_in_html_messages(monkeypatch):
+    monkeypatch.setitem(main.ZONE_NAMES, "zone-rd", "R&D <lab>")
+    monkeypatch.setitem(main.CLOUDFLARE_ZONES, "R&D <lab>", "zone-rd")
+    assert "<b>R&amp;D &lt;lab&gt;</b>" in main.zones_message("zone-rd")
+    assert "<b>R&amp;D &lt;lab&gt;</b>" in main.render_panel("🔒", "zone-rd", (("level", "high"),))
+
+
+def test_parse_zones_rejects_entries_without_a_zone_id():
+    assert main.parse_zones("site1=abc, site2 = def") == {"site1": "abc", "site2": "def"}
+    with pytest.raises(ValueError, match="broken"):
+        main.parse_zones("site1=abc,broken")